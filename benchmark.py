@@ -0,0 +1,506 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import queue
+import resource
+import statistics
+import sys
+import time
+
+import torch
+
+from models import AtoB, BtoA, S, Discriminator, De_remove, De_predict, Re_pretict, ContextBlock, set_checkpointing
+from models import use_fp32_norms
+from training import criterion_GAN, discriminate, generator_forward, train_step, MixedPrecision
+
+def time_forward(fn, x, warmup: int = 3, repeats: int = 10) -> list[float]:
+    """Wall-clock seconds of ``repeats`` calls to ``fn(x)`` after ``warmup`` untimed calls."""
+    times = []
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(x)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(x)
+            times.append(time.perf_counter() - start)
+    return times
+
+def bench_branches(sizes, batch: int = 1, warmup: int = 3, repeats: int = 10) -> list[dict]:
+    """Latency of AtoB/BtoA with their independent branches run in turn vs. forked.
+
+    Both variants are scripted and frozen, since torch.jit.fork only runs concurrently
+    inside TorchScript.
+    """
+    results = []
+    for name, net_class in [('AtoB', AtoB), ('BtoA', BtoA)]:
+        for size in sizes:
+            x = torch.randn(batch, 3, size, size)
+            row = {'model': name, 'size': size, 'batch': batch}
+            for parallel in (False, True):
+                net = net_class(3, 3, parallel_branches=parallel).eval()
+                scripted = torch.jit.freeze(torch.jit.script(net))
+                key = 'parallel_s' if parallel else 'sequential_s'
+                row[key] = statistics.median(time_forward(scripted, x, warmup, repeats))
+            row['speedup'] = row['sequential_s'] / row['parallel_s']
+            results.append(row)
+            print(f"{name:5s} {size:5d}px  sequential {row['sequential_s'] * 1000:9.1f} ms  "
+                  f"parallel {row['parallel_s'] * 1000:9.1f} ms  speedup {row['speedup']:.2f}x")
+    return results
+
+def _vggnet():
+    # utils pulls in torchvision's model zoo, so only import it when VGGNet is benchmarked.
+    from utils import VGGNet
+    return VGGNet()
+
+# name -> (constructor, input shape for a given batch and image size)
+MODULES = {
+    'AtoB': (lambda: AtoB(3, 3), lambda batch, size: (batch, 3, size, size)),
+    'BtoA': (lambda: BtoA(3, 3), lambda batch, size: (batch, 3, size, size)),
+    'S': (lambda: S(3, 3), lambda batch, size: (batch, 3, size, size)),
+    'Discriminator': (lambda: Discriminator(3), lambda batch, size: (batch, 3, size, size)),
+    'De_remove': (lambda: De_remove(gps=3, blocks=3), lambda batch, size: (batch, 3, size, size)),
+    'De_predict': (lambda: De_predict(channels=3), lambda batch, size: (batch, 3, size, size)),
+    'Re_pretict': (lambda: Re_pretict(channels=3), lambda batch, size: (batch, 3, size, size)),
+    # Inside the generators ContextBlock sees 256 channels at a quarter of the image size.
+    'ContextBlock': (lambda: ContextBlock(256), lambda batch, size: (batch, 256, size // 4, size // 4)),
+    'VGGNet': (_vggnet, lambda batch, size: (batch, 3, size, size)),
+}
+
+def _output_sum(output) -> torch.Tensor:
+    if isinstance(output, (tuple, list)):
+        return sum(o.float().mean() for o in output)
+    return output.float().mean()
+
+def time_step(step, warmup: int, repeats: int, device: torch.device) -> list[float]:
+    """Like time_forward, but for an arbitrary ``step()`` and synchronizing CUDA around each call."""
+    times = []
+    for _ in range(warmup):
+        step()
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return times
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def bench_module(name: str, size: int, batch: int, threads: int, passes: str,
+                 warmup: int = 3, repeats: int = 10, device: torch.device = torch.device('cpu'),
+                 checkpointing: tuple = ()) -> dict:
+    """Latency, throughput and peak memory of one module for one configuration.
+
+    ``passes`` is 'forward' (under no_grad) or 'train' (forward plus backward of the mean
+    of the outputs). On CUDA the peak is torch's allocator high-water mark; on CPU it is
+    the process's peak RSS above what it used before the first call, which is only
+    meaningful when every case runs in a fresh process (see run_isolated).
+    ``checkpointing`` lists models.set_checkpointing policies to enable.
+    """
+    if threads > 0:
+        torch.set_num_threads(threads)
+    build, input_shape = MODULES[name]
+    torch.manual_seed(0)
+    model = build().to(device)
+    if checkpointing:
+        set_checkpointing(model, checkpointing)
+    x = torch.randn(*input_shape(batch, size), device=device)
+
+    if passes == 'forward':
+        model.eval()
+
+        def step():
+            with torch.no_grad():
+                model(x)
+    else:
+        model.train()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            _output_sum(model(x)).backward()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = _peak_rss_mb()
+    times = time_step(step, warmup, repeats, device)
+    if device.type == 'cuda':
+        peak_mb = (torch.cuda.max_memory_allocated(device) - baseline) / 2 ** 20
+    else:
+        peak_mb = _peak_rss_mb() - baseline
+
+    latency = statistics.median(times)
+    return {
+        'module': name, 'size': size, 'batch': batch, 'threads': torch.get_num_threads(),
+        'passes': passes, 'device': device.type, 'checkpointing': '+'.join(checkpointing) or 'none',
+        'latency_s': latency, 'latency_min_s': min(times),
+        'images_per_s': batch / latency,
+        'peak_mb': peak_mb,
+    }
+
+def _isolated_case(result_queue, kwargs):
+    try:
+        result_queue.put(bench_module(**kwargs))
+    except Exception as e:
+        result_queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def run_isolated(poll_s: float = 5.0, **kwargs) -> dict:
+    """Runs bench_module in a freshly spawned process so CPU peak memory is per case.
+
+    A case whose process dies without reporting (a crash, or the OOM killer on the
+    largest sizes) gives an ``{'error': ...}`` row instead of blocking the sweep.
+    """
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=_isolated_case, args=(result_queue, kwargs))
+    process.start()
+    while True:
+        try:
+            result = result_queue.get(timeout=poll_s)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            try:
+                # The result may have been posted just before the process exited.
+                result = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                result = {'error': f"case process exited with code {process.exitcode} without a result"}
+            break
+    process.join()
+    return result
+
+def bench_modules(modules, sizes, batches, thread_counts, passes, warmup: int = 3, repeats: int = 10,
+                  device: torch.device = torch.device('cpu'), isolate: bool = True) -> list[dict]:
+    """Sweeps every module over sizes, batch sizes, thread counts and pass types."""
+    results = []
+    for name in modules:
+        for pass_type in passes:
+            for size in sizes:
+                for batch in batches:
+                    for threads in thread_counts:
+                        kwargs = dict(name=name, size=size, batch=batch, threads=threads, passes=pass_type,
+                                      warmup=warmup, repeats=repeats, device=device)
+                        row = run_isolated(**kwargs) if isolate else bench_module(**kwargs)
+                        if 'error' in row:
+                            print(f"{name:13s} {pass_type:7s} {size:5d}px  batch {batch:3d}  failed: {row['error']}")
+                            continue
+                        results.append(row)
+                        print(f"{name:13s} {pass_type:7s} {size:5d}px  batch {batch:3d}  threads {row['threads']:3d}  "
+                              f"{row['latency_s'] * 1000:9.1f} ms  {row['images_per_s']:8.2f} img/s  "
+                              f"peak {row['peak_mb']:8.1f} MB")
+    return results
+
+def bench_checkpointing(modules, sizes, batch: int, policies, warmup: int = 2, repeats: int = 5,
+                        device: torch.device = torch.device('cpu'), isolate: bool = True, threads: int = 0) -> list[dict]:
+    """Peak memory and forward+backward time per checkpointing policy, relative to the first policy."""
+    results = []
+    for name in modules:
+        for size in sizes:
+            base = None
+            for policy in policies:
+                kwargs = dict(name=name, size=size, batch=batch, threads=threads, passes='train', warmup=warmup,
+                              repeats=repeats, device=device, checkpointing=policy)
+                row = run_isolated(**kwargs) if isolate else bench_module(**kwargs)
+                label = '+'.join(policy) or 'none'
+                if 'error' in row:
+                    print(f"{name:5s} {size:5d}px  {label:16s} failed: {row['error']}")
+                    continue
+                base = base or row
+                row['memory_ratio'] = row['peak_mb'] / base['peak_mb'] if base['peak_mb'] > 0 else 1.0
+                row['time_ratio'] = row['latency_s'] / base['latency_s']
+                results.append(row)
+                print(f"{name:5s} {size:5d}px  {label:16s} peak {row['peak_mb']:9.1f} MB ({row['memory_ratio'] * 100:5.1f}%)  "
+                      f"step {row['latency_s'] * 1000:9.1f} ms ({row['time_ratio']:.2f}x)")
+    return results
+
+class SeparatePerceptualLoss:
+    """The original perceptual loss: one VGGNet call per image batch, VGG weights trainable.
+
+    Same call signature as utils.PerceptualLoss; kept as the reference for the cycle and
+    perceptual modes.
+    """
+
+    def __init__(self, vgg):
+        self.vgg = vgg
+
+    def __call__(self, reals, recons):
+        c = criterion_GAN
+        x, y = reals
+        rx, ry = recons
+        fx1, fx2 = self.vgg(x)
+        fy1, fy2 = self.vgg(y)
+        frx1, frx2 = self.vgg(rx)
+        fry1, fry2 = self.vgg(ry)
+        return c(fx1, frx1) + c(fx2, frx2) + c(fy1, fry1) + c(fy2, fry2)
+
+def build_networks(input_nc: int = 3, output_nc: int = 3, device: torch.device = torch.device('cpu')) -> dict:
+    """The six networks of train.py under the names train_step expects."""
+    return {
+        'G_A2B': AtoB(input_nc, output_nc).to(device),
+        'G_B2A': BtoA(output_nc, input_nc).to(device),
+        'G_E1': S(output_nc, output_nc).to(device),
+        'G_E2': S(input_nc, input_nc).to(device),
+        'D_A': Discriminator(input_nc).to(device),
+        'D_B': Discriminator(output_nc).to(device),
+    }
+
+def count_flops(fn) -> int:
+    """Total FLOPs of everything ``fn()`` runs, backward included."""
+    from torch.utils.flop_counter import FlopCounterMode
+    counter = FlopCounterMode(display=False)
+    with counter:
+        fn()
+    return counter.get_total_flops()
+
+def bench_generator_step(variants: dict, size: int = 128, batch: int = 1, warmup: int = 2, repeats: int = 5,
+                         device: torch.device = torch.device('cpu')) -> dict:
+    """FLOPs, time and loss value of the generator phase (forward + backward) per variant.
+
+    ``variants`` maps a name to ``(perceptual, reuse_cycle)`` arguments of generator_forward.
+    """
+    torch.manual_seed(0)
+    nets = build_networks(device=device)
+    real_A = torch.randn(batch, 3, size, size, device=device)
+    real_B = torch.randn(batch, 3, size, size, device=device)
+
+    results = {}
+    for name, (perceptual, reuse) in variants.items():
+        def step():
+            for net in nets.values():
+                net.zero_grad(set_to_none=True)
+            loss_G, losses, _ = generator_forward(nets, perceptual, real_A, real_B, reuse_cycle=reuse)
+            loss_G.backward()
+            return losses['L_G_perceptual']
+
+        row = {'flops': count_flops(step)}
+        row['seconds'] = statistics.median(time_step(step, warmup, repeats, device))
+        # Both variants run in eval mode for this, so dropout does not make the values differ.
+        for net in nets.values():
+            net.eval()
+        with torch.no_grad():
+            row['perceptual'] = generator_forward(nets, perceptual, real_A, real_B, reuse_cycle=reuse)[1]['L_G_perceptual'].item()
+        for net in nets.values():
+            net.train()
+        results[name] = row
+    return results
+
+def bench_generator_phase(compare: str, sizes, batch: int = 1, warmup: int = 2, repeats: int = 5,
+                          device: torch.device = torch.device('cpu')) -> list[dict]:
+    """cycle: the old loop vs. reused cycle outputs; perceptual: four VGGNet calls vs. PerceptualLoss."""
+    # utils pulls in torchvision's model zoo; pretrained weights do not change the cost, so skip the download.
+    from utils import VGGNet, PerceptualLoss
+    results = []
+    for size in sizes:
+        vggnet = VGGNet(pretrained=False).to(device).eval()
+        separate = SeparatePerceptualLoss(vggnet)
+        if compare == 'cycle':
+            variants = {'legacy loop': (separate, False), 'reused outputs': (separate, True)}
+        else:
+            batched = PerceptualLoss(pretrained=False).to(device)
+            batched.vgg.load_state_dict(vggnet.vgg.state_dict(), strict=False)
+            variants = {'separate VGG': (separate, True), 'batched VGG': (batched, True)}
+
+        rows = bench_generator_step(variants, size, batch, warmup, repeats, device)
+        print(f"Generator step at {size}px, batch {batch} on {device.type}:")
+        for name, row in rows.items():
+            print(f"  {name:16s} {row['flops'] / 1e9:10.1f} GFLOP  {row['seconds'] * 1000:9.1f} ms  "
+                  f"perceptual loss {row['perceptual']:.6f}")
+            results.append({'variant': name, 'size': size, 'batch': batch, 'device': device.type, **row})
+        (old_name, old), (new_name, new) = rows.items()
+        print(f"  {new_name} saves {(1 - new['flops'] / old['flops']) * 100:.1f}% FLOPs and "
+              f"{(1 - new['seconds'] / old['seconds']) * 100:.1f}% time")
+    return results
+
+def check_discriminator_batching(size: int = 128, batch: int = 1, warmup: int = 2, repeats: int = 5,
+                                 device: torch.device = torch.device('cpu')) -> dict:
+    """Largest loss difference and time of five separate vs. one batched Discriminator call.
+
+    Five calls is one generator plus one discriminator phase for one discriminator.
+    """
+    torch.manual_seed(0)
+    netD = Discriminator(3).to(device)
+    inputs = [torch.randn(batch, 3, size, size, device=device) for _ in range(5)]
+    targets = [torch.ones_like, torch.ones_like, torch.ones_like, torch.zeros_like, torch.zeros_like]
+
+    def separate():
+        preds = [netD(x) for x in inputs]
+        return [criterion_GAN(p, t(p)) for p, t in zip(preds, targets)]
+
+    def batched():
+        preds = discriminate(netD, *inputs[:2]) + discriminate(netD, *inputs[2:])
+        return [criterion_GAN(p, t(p)) for p, t in zip(preds, targets)]
+
+    result = {'size': size, 'batch': batch, 'device': device.type}
+    with torch.no_grad():
+        result['max_loss_diff'] = max(abs(a.item() - b.item()) for a, b in zip(separate(), batched()))
+    for name, fn in (('separate', separate), ('batched', batched)):
+        def step():
+            netD.zero_grad(set_to_none=True)
+            sum(fn()).backward()
+        result[name + '_s'] = statistics.median(time_step(step, warmup, repeats, device))
+    print(f"Discriminator at {size}px, batch {batch} on {device.type}: "
+          f"separate {result['separate_s'] * 1000:.1f} ms, batched {result['batched_s'] * 1000:.1f} ms, "
+          f"largest loss difference {result['max_loss_diff']:.3g}")
+    return result
+
+def synthetic_pairs(n: int, size: int, seed: int = 0):
+    """Small synthetic document-cleaning set: smooth "clean" images and stained copies of them."""
+    import torch.nn.functional as F
+    g = torch.Generator().manual_seed(seed)
+    clean = F.interpolate(torch.rand(n, 3, size // 8, size // 8, generator=g), size=size, mode='bilinear') * 2 - 1
+    stains = (F.interpolate(torch.rand(n, 1, size // 16, size // 16, generator=g), size=size, mode='bilinear') > 0.6).float()
+    degraded = clean * (1 - 0.5 * stains) - 0.3 * stains
+    return degraded, clean
+
+def compare_amp_convergence(steps: int = 50, size: int = 64, batch: int = 2, log_every: int = 10,
+                            device: torch.device = torch.device('cpu')) -> list[dict]:
+    """Trains the same initialization on the same synthetic batches in fp32 and with --amp.
+
+    Returns the generator and discriminator losses of both runs every ``log_every`` steps.
+    """
+    from utils import PerceptualLoss, ReplayBuffer
+
+    real_A_all, real_B_all = synthetic_pairs(max(batch * 4, 8), size)
+    curves = {}
+    for mode in ('fp32', 'amp'):
+        torch.manual_seed(0)
+        nets = build_networks(device=device)
+        if mode == 'amp':
+            for net in nets.values():
+                use_fp32_norms(net)
+        perceptual = PerceptualLoss(pretrained=False).to(device)
+        optimizers = {
+            'G': torch.optim.Adam(itertools.chain(*(nets[k].parameters() for k in ('G_A2B', 'G_B2A', 'G_E1', 'G_E2'))),
+                                  lr=1e-4, betas=(0.5, 0.999)),
+            'D_A': torch.optim.Adam(nets['D_A'].parameters(), lr=1e-4, betas=(0.5, 0.999)),
+            'D_B': torch.optim.Adam(nets['D_B'].parameters(), lr=1e-4, betas=(0.5, 0.999)),
+        }
+        buffers = {name: ReplayBuffer() for name in ('fake_A', 'fake_B', 'E_A', 'E_B')}
+        amp = MixedPrecision(device, enabled=mode == 'amp')
+        curve = []
+        for step in range(steps):
+            start = (step * batch) % real_A_all.size(0)
+            real_A = real_A_all[start:start + batch].to(device)
+            real_B = real_B_all[start:start + batch].to(device)
+            losses, _ = train_step(nets, optimizers, buffers, perceptual, real_A, real_B, amp)
+            if (step + 1) % log_every == 0:
+                curve.append({'step': step + 1, 'L_G': losses['L_G'].item(), 'L_D': losses['L_D'].item()})
+        curves[mode] = curve
+
+    rows = [{'step': a['step'], 'fp32_L_G': a['L_G'], 'amp_L_G': b['L_G'], 'fp32_L_D': a['L_D'], 'amp_L_D': b['L_D']}
+            for a, b in zip(curves['fp32'], curves['amp'])]
+    print(f"Training {steps} steps at {size}px, batch {batch} on {device.type}, fp32 vs. "
+          f"{'float16' if device.type == 'cuda' else 'bfloat16'} autocast:")
+    print(f"{'step':>6s} {'fp32 L_G':>10s} {'amp L_G':>10s} {'fp32 L_D':>10s} {'amp L_D':>10s}")
+    for row in rows:
+        print(f"{row['step']:6d} {row['fp32_L_G']:10.4f} {row['amp_L_G']:10.4f} {row['fp32_L_D']:10.4f} {row['amp_L_D']:10.4f}")
+    return rows
+
+def _case_key(row: dict) -> tuple:
+    return (row['module'], row['passes'], row['size'], row['batch'], row['threads'], row.get('device', 'cpu'),
+            row.get('checkpointing', 'none'))
+
+def compare_results(baseline: list[dict], current: list[dict], threshold: float = 0.1) -> list[str]:
+    """Lists cases whose latency or peak memory grew by more than ``threshold`` over the baseline."""
+    reference = {_case_key(row): row for row in baseline}
+    regressions = []
+    for row in current:
+        base = reference.get(_case_key(row))
+        if base is None:
+            continue
+        label = '{} {} {}px batch {} threads {}'.format(*_case_key(row)[:5])
+        for metric in ('latency_s', 'peak_mb'):
+            if metric not in row or metric not in base:
+                continue
+            # Memory deltas of a few MB are noise; only compare peaks that are meaningfully sized.
+            if metric == 'peak_mb' and base[metric] < 1.0:
+                continue
+            change = row[metric] / base[metric] - 1 if base[metric] > 0 else 0.0
+            if change > threshold:
+                regressions.append(f"{label}: {metric} {base[metric]:.4g} -> {row[metric]:.4g} (+{change * 100:.1f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the CDSR-CycleGAN networks.')
+    parser.add_argument('--mode', type=str, default='branches', choices=['branches', 'modules', 'checkpointing', 'cycle', 'perceptual', 'discriminator', 'amp'], help='branches: sequential vs. forked generator branches per image size; modules: latency, throughput and peak memory per network; checkpointing: training memory vs. step time per activation checkpointing policy; cycle: old generator loop vs. reused cycle outputs; perceptual: four VGGNet calls vs. the frozen, batched PerceptualLoss; discriminator: one Discriminator call per batch vs. one per phase; amp: loss curves of fp32 vs. --amp training on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help='Square input sizes to benchmark (default: 256 512 1024; 256 384 512 for checkpointing; 128 for cycle, perceptual and discriminator; 64 for amp, which uses the first size only).')
+    parser.add_argument('--batch', type=int, default=1, help='Batch size of the benchmark input (all modes but modules).')
+    parser.add_argument('--steps', type=int, default=50, help='Training steps per run (amp mode).')
+    parser.add_argument('--modules', type=str, nargs='+', default=None, choices=list(MODULES), help='Networks to benchmark (default: all in modules mode, AtoB and BtoA in checkpointing mode).')
+    parser.add_argument('--policies', type=str, nargs='+', default=['none', 'residual', 'tfam', 'branch', 'branch+residual'], help='Checkpointing policies to compare, "+"-joined combinations of tfam, branch and residual (checkpointing mode).')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1], help='Batch sizes to sweep (modules mode).')
+    parser.add_argument('--thread_counts', type=int, nargs='+', default=[0], help='torch intra-op thread counts to sweep, 0 = --threads (modules mode).')
+    parser.add_argument('--passes', type=str, nargs='+', default=['forward', 'train'], choices=['forward', 'train'], help='forward: inference under no_grad; train: forward plus backward (modules mode).')
+    parser.add_argument('--no_isolate', action='store_true', help='Run every case in this process instead of a fresh one; faster, but CPU peak memory is no longer per case.')
+    parser.add_argument('--cuda', action='store_true', help='Benchmark on the GPU if available (all modes but branches).')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline JSON from an earlier run; cases that got slower or use more memory are reported and the exit code is 1.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative increase over the baseline that counts as a regression.')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed iterations before measuring.')
+    parser.add_argument('--repeats', type=int, default=10, help='Timed iterations (the median is reported).')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default); also applied to every case of the modules and checkpointing modes.')
+    parser.add_argument('--interop_threads', type=int, default=0, help='torch inter-op threads that run forked branches (0 = torch default).')
+    parser.add_argument('--json', type=str, default=None, help='Optional path to write the results as JSON.')
+    args = parser.parse_args()
+
+    # Inter-op threads can only be set before any parallel work has started.
+    if args.interop_threads > 0:
+        torch.set_num_interop_threads(args.interop_threads)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print(f"torch {torch.__version__}: {torch.get_num_threads()} intra-op threads, "
+          f"{torch.get_num_interop_threads()} inter-op threads")
+
+    device = torch.device('cuda' if args.cuda and torch.cuda.is_available() else 'cpu')
+    if args.mode == 'checkpointing':
+        policies = [tuple(p for p in policy.split('+') if p != 'none') for policy in args.policies]
+        results = bench_checkpointing(args.modules or ['AtoB', 'BtoA'], args.sizes or [256, 384, 512], args.batch,
+                                      policies, args.warmup, args.repeats, device, isolate=not args.no_isolate,
+                                      threads=args.threads)
+    elif args.mode == 'modules':
+        # Isolated cases run in fresh processes, so --threads has to be handed to each of them.
+        thread_counts = [threads or args.threads for threads in args.thread_counts]
+        results = bench_modules(args.modules or list(MODULES), args.sizes or [256, 512, 1024], args.batches, thread_counts, args.passes,
+                                args.warmup, args.repeats, device, isolate=not args.no_isolate)
+    elif args.mode in ('cycle', 'perceptual'):
+        results = bench_generator_phase(args.mode, args.sizes or [128], args.batch, args.warmup, args.repeats, device)
+    elif args.mode == 'discriminator':
+        results = [check_discriminator_batching(size, args.batch, args.warmup, args.repeats, device)
+                   for size in args.sizes or [128]]
+    elif args.mode == 'amp':
+        results = compare_amp_convergence(args.steps, (args.sizes or [64])[0], args.batch, max(args.steps // 10, 1), device)
+    else:
+        results = bench_branches(args.sizes or [256, 512, 1024], args.batch, args.warmup, args.repeats)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'mode': args.mode, 'torch': torch.__version__, 'results': results}, f, indent=2)
+        print(f"Results written to: {args.json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('mode') != args.mode:
+            print(f"Error: baseline {args.compare} was recorded in {baseline.get('mode')} mode, not {args.mode}.")
+            sys.exit(2)
+        if args.mode != 'modules':
+            print("--compare only checks modules-mode results.")
+            return
+        regressions = compare_results(baseline['results'], results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold * 100:.0f}% against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions over {args.threshold * 100:.0f}% against {args.compare}.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import glob
+import json
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+INDEX_FILENAME = 'checkpoints.json'
+
+def to_cpu(value):
+    """Detached CPU copies of every tensor in a (nested) state dict; other values are kept as they are."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: to_cpu(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(v) for v in value)
+    return value
+
+def atomic_save(obj, path: str):
+    """torch.save to a temporary file next to ``path``, then rename it over ``path``.
+
+    A crash mid-write leaves the previous file intact instead of a truncated one.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def rng_state() -> dict:
+    """State of the python, numpy, torch and (if present) CUDA random generators."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state: dict):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointManager:
+    """Writes full training checkpoints from a background thread and prunes old ones.
+
+    save() takes a state that is already on the CPU (see to_cpu), so training continues
+    while the file is written; at most one write is pending and a further save() waits
+    for it. Every file goes through atomic_save. The manager keeps the ``keep_last``
+    newest checkpoints plus the one with the lowest metric, and lists them in
+    ``checkpoints.json``, which is only updated after the file it points to is complete.
+
+    Under DDP every rank has a manager: rank 0 writes ``step_XXXXXXXX.pt`` and the index,
+    rank r > 0 writes only its rank-local state to ``step_XXXXXXXX.rank<r>.pt``. All ranks
+    must pass the same metric so they prune the same steps.
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3, rank: int = 0):
+        assert keep_last > 0, 'keep_last must be at least 1'
+        self.directory = directory
+        self.keep_last = keep_last
+        self.rank = rank
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)['checkpoints']
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _filename(self, step: int, rank: int = None) -> str:
+        rank = self.rank if rank is None else rank
+        suffix = '.pt' if rank == 0 else '.rank%d.pt' % rank
+        return os.path.join(self.directory, 'step_%08d%s' % (step, suffix))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                kind, payload = item
+                if kind == 'files':
+                    for path, obj in payload.items():
+                        atomic_save(obj, path)
+                else:
+                    entry, state = payload
+                    atomic_save(state, self._filename(entry['step']))
+                    self._add_entry(entry)
+            except Exception as e:
+                print(f"\nWARNING: checkpoint write failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _add_entry(self, entry: dict):
+        self.entries = [e for e in self.entries if e['step'] != entry['step']] + [entry]
+        self.entries.sort(key=lambda e: e['step'])
+        keep = self.entries[-self.keep_last:]
+        best = self.best()
+        if best is not None and best not in keep:
+            keep.append(best)
+        for old in self.entries:
+            if old not in keep and os.path.exists(self._filename(old['step'])):
+                os.remove(self._filename(old['step']))
+        self.entries = sorted(keep, key=lambda e: e['step'])
+        if self.rank == 0:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'checkpoints': self.entries}, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+
+    def best(self):
+        scored = [e for e in self.entries if e.get('metric') is not None]
+        return min(scored, key=lambda e: e['metric']) if scored else None
+
+    def save(self, state: dict, epoch: int, step: int, metric: float = None):
+        """Queues ``state`` (CPU tensors only) as the checkpoint of global ``step``."""
+        entry = {'step': step, 'epoch': epoch, 'metric': metric}
+        self._queue.put(('checkpoint', (entry, state)))
+
+    def save_files(self, files: dict):
+        """Queues atomic writes of ``{path: object}``, e.g. the per-network .pth exports."""
+        self._queue.put(('files', files))
+
+    def resolve(self, spec: str) -> str:
+        """Checkpoint path for ``spec``: 'latest', 'best', or the path of a rank-0 checkpoint file."""
+        if spec not in ('latest', 'best'):
+            return spec
+        entry = self.best() if spec == 'best' else (self.entries[-1] if self.entries else None)
+        if entry is None:
+            # No index (e.g. it was deleted): fall back to the newest file on disk.
+            files = sorted(f for f in glob.glob(os.path.join(self.directory, 'step_*.pt')) if '.rank' not in f)
+            if not files:
+                raise FileNotFoundError(f"no checkpoint in {self.directory}")
+            return files[-1]
+        return self._filename(entry['step'], rank=0)
+
+    def load(self, spec: str) -> dict:
+        """Loads the checkpoint named by ``spec`` onto the CPU.
+
+        On rank r > 0 the ``local`` entry comes from that rank's own file, or is None when
+        there is none (e.g. the run had fewer ranks); that rank then keeps fresh replay
+        buffers and random state.
+        """
+        path = self.resolve(spec)
+        state = torch.load(path, map_location='cpu', weights_only=False)
+        if self.rank > 0:
+            rank_path = path[:-len('.pt')] + '.rank%d.pt' % self.rank
+            state['local'] = None
+            if os.path.exists(rank_path):
+                state['local'] = torch.load(rank_path, map_location='cpu', weights_only=False)['local']
+        return state
+
+    def wait(self):
+        """Blocks until every queued write is on disk."""
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
@@ -1,8 +1,16 @@
+import argparse
 import glob
+import hashlib
+import io
+import itertools
+import json
 import random
 import os
+import tarfile
 
-from torch.utils.data import Dataset
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DistributedSampler, IterableDataset, get_worker_info
 from PIL import Image
 import torchvision.transforms as transforms
 
@@ -34,3 +42,360 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return max(len(self.files_A), len(self.files_B))
+
+
+def source_fingerprint(files, load_size):
+    """Hash of the file list, sizes, mtimes and resize size; any change invalidates a cache."""
+    digest = hashlib.sha256(json.dumps({'load_size': load_size}).encode('utf-8'))
+    for path in files:
+        stat = os.stat(path)
+        digest.update(json.dumps([os.path.basename(path), stat.st_size, stat.st_mtime_ns]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_image_cache(files, cache_prefix, load_size):
+    """Decodes and resizes ``files`` once into a flat uint8 shard ``<prefix>.u8`` plus ``<prefix>.json``.
+
+    Images are resized exactly like ``transforms.Resize(load_size, Image.BICUBIC)`` and
+    stored back to back as HxWx3 arrays; the JSON index holds each image's byte offset
+    and shape. Both files are written under temporary names and renamed when complete.
+    """
+    resize = transforms.Resize(load_size, Image.BICUBIC)
+    index = []
+    offset = 0
+    with open(cache_prefix + '.u8.tmp', 'wb') as f:
+        for path in files:
+            array = np.asarray(resize(Image.open(path).convert('RGB')), dtype=np.uint8)
+            f.write(array.tobytes())
+            index.append([offset, array.shape[0], array.shape[1]])
+            offset += array.nbytes
+    with open(cache_prefix + '.json.tmp', 'w') as f:
+        json.dump({'fingerprint': source_fingerprint(files, load_size), 'load_size': load_size,
+                   'files': [os.path.basename(path) for path in files], 'index': index}, f)
+    os.replace(cache_prefix + '.u8.tmp', cache_prefix + '.u8')
+    os.replace(cache_prefix + '.json.tmp', cache_prefix + '.json')
+
+
+def load_cache_index(files, cache_prefix, load_size):
+    """Returns the cache index if it exists and still matches ``files`` and ``load_size``, else None."""
+    try:
+        with open(cache_prefix + '.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('fingerprint') != source_fingerprint(files, load_size) or not os.path.exists(cache_prefix + '.u8'):
+        return None
+    return meta['index']
+
+
+def ensure_image_cache(files, cache_prefix, load_size):
+    """Loads the cache index for ``files``, (re)building the cache first if it is missing or stale."""
+    index = load_cache_index(files, cache_prefix, load_size)
+    if index is None:
+        print(f"Building image cache {cache_prefix}.u8 from {len(files)} images ...")
+        build_image_cache(files, cache_prefix, load_size)
+        index = load_cache_index(files, cache_prefix, load_size)
+    return index
+
+
+class CachedImageDataset(Dataset):
+    """ImageDataset served from the memory-mapped cache built by build_image_cache.
+
+    Each sample is a random ``size`` crop and random horizontal flip of the cached,
+    already-resized image, normalized to [-1, 1]. This matches ImageDataset with the
+    Resize/RandomCrop/RandomHorizontalFlip/ToTensor/Normalize transforms of train.py,
+    without decoding or resizing anything per sample.
+    """
+
+    def __init__(self, root, size, load_size=None, unaligned=False, mode='train', cache_dir=None, flip=True):
+        self.size = size
+        self.load_size = load_size or int(size * 1.12)
+        self.unaligned = unaligned
+        self.flip = flip
+        cache_dir = cache_dir or os.path.join(root, 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.prefixes = {}
+        self.indexes = {}
+        for domain in ('A', 'B'):
+            files = sorted(glob.glob(os.path.join(root, '%s/%s' % (mode, domain)) + '/*.*'))
+            prefix = os.path.join(cache_dir, '%s_%s_%d' % (mode, domain, self.load_size))
+            self.prefixes[domain] = prefix
+            self.indexes[domain] = ensure_image_cache(files, prefix, self.load_size)
+        # Opened lazily in each process: pickling a memmap into DataLoader workers would copy it.
+        self._maps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _sample(self, domain, i):
+        if domain not in self._maps:
+            self._maps[domain] = np.memmap(self.prefixes[domain] + '.u8', dtype=np.uint8, mode='r')
+        offset, height, width = self.indexes[domain][i]
+        image = self._maps[domain][offset:offset + height * width * 3].reshape(height, width, 3)
+
+        top = random.randint(0, height - self.size)
+        left = random.randint(0, width - self.size)
+        crop = image[top:top + self.size, left:left + self.size]
+        if self.flip and random.random() < 0.5:
+            crop = crop[:, ::-1]
+        return torch.from_numpy(np.ascontiguousarray(crop)).permute(2, 0, 1).float().div_(127.5).sub_(1.0)
+
+    def __getitem__(self, index):
+        item_A = self._sample('A', index % len(self.indexes['A']))
+
+        if self.unaligned:
+            item_B = self._sample('B', random.randint(0, len(self.indexes['B']) - 1))
+        else:
+            item_B = self._sample('B', index % len(self.indexes['B']))
+
+        return {'A': item_A, 'B': item_B}
+
+    def __len__(self):
+        return max(len(self.indexes['A']), len(self.indexes['B']))
+
+
+SHARD_INDEX = '%s_shards.json'
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffling sampler whose order depends only on the seed and the epoch.
+
+    A DistributedSampler (which also works with a single replica and no process group)
+    that can leave out the first ``skip`` samples of one epoch, so a run resumed from a
+    mid-epoch checkpoint sees exactly the samples it had not trained on yet.
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.skip = 0
+
+    def set_epoch(self, epoch, skip=0):
+        super().set_epoch(epoch)
+        self.skip = skip
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.skip, None)
+
+    def __len__(self):
+        return super().__len__() - self.skip
+
+
+def write_tar_shards(root, out_dir, mode='train', shard_size=1000):
+    """Packs ``<root>/<mode>/{A,B}`` into sequential tar shards of ``shard_size`` images each.
+
+    Images are stored as their original encoded bytes. ``<mode>_shards.json`` in
+    ``out_dir`` lists the shards and image counts per domain, so a TarShardDataset knows
+    its length without opening any shard.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {}
+    for domain in ('A', 'B'):
+        files = sorted(glob.glob(os.path.join(root, '%s/%s' % (mode, domain)) + '/*.*'))
+        shards = []
+        for start in range(0, len(files), shard_size):
+            name = '%s_%s_%05d.tar' % (mode, domain, len(shards))
+            with tarfile.open(os.path.join(out_dir, name + '.tmp'), 'w') as tar:
+                for path in files[start:start + shard_size]:
+                    tar.add(path, arcname=os.path.basename(path))
+            os.replace(os.path.join(out_dir, name + '.tmp'), os.path.join(out_dir, name))
+            shards.append(name)
+        meta[domain] = {'shards': shards, 'count': len(files)}
+        print(f"{mode}/{domain}: {len(files)} images in {len(shards)} shards")
+    with open(os.path.join(out_dir, SHARD_INDEX % mode), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def _iter_tar(path):
+    # Stream mode ('r|') reads the shard front to back without seeking.
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if member.isfile():
+                yield tar.extractfile(member).read()
+
+
+def _shuffled(samples, buffer_size, rng):
+    """Approximate shuffle of a stream through a buffer of ``buffer_size`` samples."""
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class TarShardDataset(IterableDataset):
+    """Streams A/B pairs from the tar shards written by write_tar_shards.
+
+    Shards are read sequentially, so an epoch costs a handful of large reads instead of
+    one open per image. Every (rank, worker) pair gets a disjoint slice of the A shards,
+    reshuffled each epoch (call set_epoch), and streams them through a shuffle buffer.
+    With ``unaligned`` each worker pairs A with an endless, independently shuffled
+    stream over all B shards, like ImageDataset's random B index. Without it, A and B
+    shards are read in lockstep and pairs are shuffled together; that needs equal A and B
+    counts.
+
+    Every rank yields exactly len(self) samples per epoch, one rank's share of the A
+    images, split evenly over its workers. Each worker cycles through its shards
+    (reshuffled on every pass) or stops early to meet its share. Then ranks with
+    unevenly sized shards still run the same number of batches, which DDP needs.
+    ``num_workers`` must be the DataLoader's; there must be at least one A shard per
+    (rank, worker) pair.
+    """
+
+    def __init__(self, shard_dir, transforms_=None, unaligned=False, mode='train',
+                 shuffle_buffer=256, seed=0, rank=0, world_size=1, num_workers=0):
+        self.shard_dir = shard_dir
+        self.transform = transforms.Compose(transforms_)
+        self.unaligned = unaligned
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        with open(os.path.join(shard_dir, SHARD_INDEX % mode)) as f:
+            self.meta = json.load(f)
+        if unaligned and not self.meta['B']['shards']:
+            raise ValueError(f"no B shards in {shard_dir}; unaligned pairing needs at least one")
+        if not unaligned and self.meta['A']['count'] != self.meta['B']['count']:
+            # A and B are chunked separately, so their shards only line up when the counts match.
+            raise ValueError(f"aligned pairs need as many A as B images, but {shard_dir} has "
+                             f"{self.meta['A']['count']} A and {self.meta['B']['count']} B; use unaligned=True")
+        slots = world_size * max(num_workers, 1)
+        if len(self.meta['A']['shards']) < slots:
+            raise ValueError(f"{len(self.meta['A']['shards'])} A shards in {shard_dir} cannot feed {world_size} "
+                             f"rank(s) x {max(num_workers, 1)} loader worker(s); write smaller shards")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _decode(self, data):
+        return self.transform(Image.open(io.BytesIO(data)).convert('RGB'))
+
+    def _stream(self, shards):
+        for name in shards:
+            yield from _iter_tar(os.path.join(self.shard_dir, name))
+
+    def _passes(self, indices, rng):
+        # Endless, reshuffled passes over a slot's shard indices.
+        while True:
+            indices = list(indices)
+            rng.shuffle(indices)
+            yield from indices
+
+    def _endless_stream(self, shards, rng):
+        while True:
+            shards = list(shards)
+            rng.shuffle(shards)
+            yield from self._stream(shards)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        slot = self.rank * num_workers + worker_id
+        slots = self.world_size * num_workers
+
+        # The shard order is shared by all workers so their slices stay disjoint.
+        order = list(range(len(self.meta['A']['shards'])))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        mine = order[slot::slots]
+        if not mine:
+            raise ValueError(f"no A shard for rank {self.rank}, worker {worker_id}; write smaller shards")
+        rng = random.Random((self.seed + self.epoch) * slots + slot)
+        share = len(self)
+        quota = share // num_workers + (worker_id < share % num_workers)
+
+        if self.unaligned:
+            stream_A = self._stream(self.meta['A']['shards'][i] for i in self._passes(mine, rng))
+            stream_B = self._endless_stream(self.meta['B']['shards'], rng)
+            pairs = ((a, next(stream_B)) for a in _shuffled(stream_A, self.shuffle_buffer, rng))
+        else:
+            indices_A, indices_B = itertools.tee(self._passes(mine, rng))
+            stream_A = self._stream(self.meta['A']['shards'][i] for i in indices_A)
+            stream_B = self._stream(self.meta['B']['shards'][i] for i in indices_B)
+            pairs = _shuffled(zip(stream_A, stream_B), self.shuffle_buffer, rng)
+
+        for data_A, data_B in itertools.islice(pairs, quota):
+            yield {'A': self._decode(data_A), 'B': self._decode(data_B)}
+
+    def __len__(self):
+        return -(-self.meta['A']['count'] // self.world_size)
+
+
+def pad_collate(batch):
+    """Collates variable-size uint8 CxHxW images by zero-padding them to the largest in the batch.
+
+    Each domain ``X`` gets an ``X_size`` entry with the (height, width) of every
+    unpadded image, which BatchAugment uses to keep its crops inside the real pixels.
+    """
+    collated = {}
+    for key in batch[0]:
+        images = [sample[key] for sample in batch]
+        height = max(image.shape[1] for image in images)
+        width = max(image.shape[2] for image in images)
+        padded = images[0].new_zeros((len(images), images[0].shape[0], height, width))
+        for i, image in enumerate(images):
+            padded[i, :, :image.shape[1], :image.shape[2]] = image
+        collated[key] = padded
+        collated[key + '_size'] = torch.tensor([image.shape[1:] for image in images])
+    return collated
+
+
+class BatchAugment:
+    """RandomCrop, RandomHorizontalFlip, ToTensor and Normalize on a whole uint8 batch at once.
+
+    Crop offsets and flips are drawn independently per sample, uniformly over each
+    image's real (unpadded) size as RandomCrop does, and applied with one gather, so
+    the output has the same distribution as the per-sample PIL transforms. Run it on
+    the training device after the batch has been transferred.
+    """
+
+    def __init__(self, size, flip=True, mean=0.5, std=0.5):
+        self.size = size
+        self.flip = flip
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, images, sizes):
+        n = images.shape[0]
+        device = images.device
+        sizes = sizes.to(device)
+        steps = torch.arange(self.size, device=device)
+        # Uniform integer offsets in [0, dim - size], like RandomCrop.get_params.
+        top = (torch.rand(n, device=device) * (sizes[:, 0] - self.size + 1)).long()
+        left = (torch.rand(n, device=device) * (sizes[:, 1] - self.size + 1)).long()
+        rows = top[:, None] + steps
+        cols = left[:, None] + steps
+        if self.flip:
+            flipped = torch.rand(n, device=device) < 0.5
+            cols = torch.where(flipped[:, None], left[:, None] + self.size - 1 - steps, cols)
+
+        # Advanced indexing puts the indexed dims first: the result is N x size x size x C.
+        crops = images[torch.arange(n, device=device)[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+        crops = crops.permute(0, 3, 1, 2).float().div_(255.0)
+        return crops.sub_(self.mean).div_(self.std)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess a dataset for train.py: the --cache mmap cache or the --shards tar shards.')
+    parser.add_argument('--dataroot', type=str, required=True, help='root directory of the dataset')
+    parser.add_argument('--build', type=str, default='cache', choices=['cache', 'shards'], help='what to build')
+    parser.add_argument('--size', type=int, default=256, help='training crop size; cached images are resized to 1.12x this')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train'], help='dataset splits to convert')
+    parser.add_argument('--cache_dir', type=str, default=None, help='where to write the cache (default: <dataroot>/cache)')
+    parser.add_argument('--shard_dir', type=str, default=None, help='where to write the tar shards (default: <dataroot>/shards)')
+    parser.add_argument('--shard_size', type=int, default=1000, help='images per tar shard')
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        if args.build == 'shards':
+            write_tar_shards(args.dataroot, args.shard_dir or os.path.join(args.dataroot, 'shards'), mode, args.shard_size)
+        else:
+            dataset = CachedImageDataset(args.dataroot, args.size, mode=mode, cache_dir=args.cache_dir)
+            print(f"Cache ready: {len(dataset.indexes['A'])} A and {len(dataset.indexes['B'])} B images at {dataset.load_size}px.")
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+
+import torch
+
+from models import optimize_for_inference
+from manifest import file_sha256
+from inference import load_model
+
+def export_torchscript(model: torch.nn.Module, example: torch.Tensor) -> torch.jit.ScriptModule:
+    """Compiles an eval-mode model into a frozen, inference-optimized TorchScript module.
+
+    Scripting keeps the graph shape-agnostic so any patch size can be used at load time;
+    tracing on ``example`` is the fallback if scripting fails. Freezing inlines the
+    weights and folds away eval-mode no-ops such as Dropout2d.
+    """
+    try:
+        scripted = torch.jit.script(model)
+    except Exception as e:
+        print(f"Scripting failed ({e}); falling back to tracing.")
+        scripted = torch.jit.trace(model, example)
+    frozen = torch.jit.freeze(scripted)
+    return torch.jit.optimize_for_inference(frozen)
+
+def export_onnx(model: torch.nn.Module, example: torch.Tensor, output: str, opset: int = 17):
+    """Writes an ONNX graph with dynamic batch and spatial axes."""
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ('input', 'output')}
+    torch.onnx.export(model, example, output, input_names=['input'], output_names=['output'],
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+
+def check_onnx(output: str, example: torch.Tensor, reference: torch.Tensor):
+    """Runs the exported graph in ONNX Runtime (if installed) and compares it with eager."""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("onnxruntime is not installed; skipping the ONNX correctness check.")
+        return
+    session = ort.InferenceSession(output, providers=['CPUExecutionProvider'])
+    result = session.run(None, {'input': example.cpu().numpy()})[0]
+    max_abs_diff = (torch.from_numpy(result) - reference.cpu()).abs().max().item()
+    print(f"Max abs difference vs eager model: {max_abs_diff:.2e}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the AtoB generator as a self-contained inference artifact.')
+    parser.add_argument('--model_path', type=str, default='Output/S-color0.5/model/netG_A2B.pth', help='Path to the trained generator checkpoint (netG_A2B).')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'], help='Artifact format: a frozen TorchScript module or an ONNX graph for ONNX Runtime.')
+    parser.add_argument('--output', type=str, default=None, help='Where to write the exported artifact (default: next to --model_path, named after the format).')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version.')
+    parser.add_argument('--input_nc', type=int, default=3, help='Number of channels of input data for the model.')
+    parser.add_argument('--output_nc', type=int, default=3, help='Number of channels of output data for the model.')
+    parser.add_argument('--patch_size', type=int, default=256, help='Patch size used for the example input and the correctness check.')
+    parser.add_argument('--parallel_branches', action='store_true', help='TorchScript only: run the independent De_predict and De_remove branches concurrently via torch.jit.fork.')
+    parser.add_argument('--cuda', action='store_true', help='Export for GPU. Artifacts are optimized for the device they are exported on.')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if args.cuda and torch.cuda.is_available() else 'cpu')
+    if not os.path.exists(args.model_path):
+        print(f"Error: Model file not found at {args.model_path}")
+        return
+
+    if args.output is None:
+        extension = '.onnx' if args.format == 'onnx' else '.torchscript.pt'
+        args.output = os.path.splitext(args.model_path)[0] + extension
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    # The eager reference: the checkpoint as inference.py loads it, before any rewrite.
+    model = load_model(args.model_path, 'eager', args.input_nc, args.output_nc, device, optimize=False)
+    example = torch.randn(1, args.input_nc, args.patch_size, args.patch_size, device=device)
+    with torch.no_grad():
+        reference = model(example)
+
+    # ONNX Runtime picks its own layouts; channels_last only helps the TorchScript/oneDNN path.
+    model = optimize_for_inference(model, channels_last=args.format == 'torchscript')
+
+    if args.format == 'onnx':
+        if args.parallel_branches:
+            print("--parallel_branches only applies to TorchScript; ONNX Runtime schedules branches itself.")
+        export_onnx(model, example, args.output, args.opset)
+        print(f"Saved ONNX model to: {args.output}")
+        check_onnx(args.output, example, reference)
+        return
+
+    model.parallel_branches = args.parallel_branches
+    with torch.no_grad():
+        exported = export_torchscript(model, example)
+        result = exported(example)
+    max_abs_diff = (result - reference).abs().max().item()
+    print(f"Max abs difference vs eager model: {max_abs_diff:.2e}")
+
+    metadata = {
+        'input_nc': args.input_nc,
+        'output_nc': args.output_nc,
+        'device': device.type,
+        'source_checkpoint_sha256': file_sha256(args.model_path),
+    }
+    torch.jit.save(exported, args.output, _extra_files={'metadata.json': json.dumps(metadata)})
+    print(f"Saved TorchScript artifact to: {args.output}")
+
+if __name__ == '__main__':
+    main()
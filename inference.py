@@ -1,19 +1,21 @@
 \
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 from PIL import Image
 import os
 import argparse
+import io
 import math
+import queue
+import threading
+import time
+import traceback
+from collections import deque
 
-# Attempt to import the model.
-# This assumes 'models.py' is in the same directory or accessible in PYTHONPATH.
-try:
-    from models import AtoB
-except ImportError:
-    print("Error: Could not import 'AtoB' from 'models.py'. Make sure 'models.py' is accessible.")
-    print("If 'models.py' is in a different location, you might need to adjust PYTHONPATH or the import statement.")
-    exit(1)
+from manifest import Manifest, ForwardingManifest, bytes_sha256, model_fingerprint
+from profiler import ModuleProfiler
 
 def get_image_paths(directory: str, exclude_subdir: str = None) -> list[str]:
     """Gets all valid image file paths from a directory, optionally excluding a subdirectory."""
@@ -31,51 +33,67 @@ def get_image_paths(directory: str, exclude_subdir: str = None) -> list[str]:
                 image_paths.append(os.path.join(root, file))
     return image_paths
 
-def pad_image_to_patch_size(image: Image.Image, patch_size: int) -> tuple[Image.Image, tuple[int, int]]:
-    """Pads an image so its dimensions are divisible by patch_size."""
-    original_width, original_height = image.size
-    
-    pad_width = math.ceil(original_width / patch_size) * patch_size
-    pad_height = math.ceil(original_height / patch_size) * patch_size
-
-    if image.mode == 'RGBA':
-        padding_color = (0, 0, 0, 0) 
-    elif image.mode == 'L':
-        padding_color = 0 
-    else: 
-        padding_color = (0, 0, 0) 
-
-    padded_image = Image.new(image.mode, (pad_width, pad_height), padding_color)
-    padded_image.paste(image, (0, 0))
-    return padded_image, (original_width, original_height)
-
-def unpad_image(image: Image.Image, original_width: int, original_height: int) -> Image.Image:
-    """Crops a padded image back to its original dimensions."""
-    return image.crop((0, 0, original_width, original_height))
-
-def create_patches_from_image(padded_image: Image.Image, patch_size: int) -> list[dict]:
-    """Creates a list of patches from a padded image."""
-    patches_info = []
-    width, height = padded_image.size
-    for y_coord in range(0, height, patch_size):
-        for x_coord in range(0, width, patch_size):
-            patch = padded_image.crop((x_coord, y_coord, x_coord + patch_size, y_coord + patch_size))
-            patches_info.append({'image_pil': patch, 'coords': (x_coord, y_coord)})
-    return patches_info
-
-def stitch_patches_to_image(processed_patches_info: list, target_width: int, target_height: int) -> Image.Image:
-    """Stitches processed PIL image patches back into a full image."""
-    if not processed_patches_info:
-        raise ValueError("No processed patches to stitch.")
-
-    output_mode = processed_patches_info[0]['image_pil'].mode
-    
-    final_image = Image.new(output_mode, (target_width, target_height))
-    for patch_info in processed_patches_info:
-        patch_pil = patch_info['image_pil']
-        coords = patch_info['coords']
-        final_image.paste(patch_pil, coords)
-    return final_image
+def image_to_tensor(image: Image.Image) -> torch.Tensor:
+    """Converts a PIL image to a CHW float tensor normalized to [-1, 1] like the training data."""
+    return TF.pil_to_tensor(image.convert('RGB')).float().div_(127.5).sub_(1.0)
+
+def _covering_length(length: int, tile_size: int, stride: int) -> int:
+    """Smallest length >= ``length`` that a grid of tiles with this stride covers exactly."""
+    if length <= tile_size:
+        return tile_size
+    return tile_size + math.ceil((length - tile_size) / stride) * stride
+
+def extract_tiles(image: torch.Tensor, tile_size: int, overlap: int) -> tuple[torch.Tensor, dict]:
+    """Pads a CHW image and cuts it into overlapping tiles with a single unfold.
+
+    Returns the tiles as an (N, C, tile_size, tile_size) tensor together with the
+    layout that ``stitch_tiles`` needs to put them back together.
+    """
+    stride = tile_size - overlap
+    channels, height, width = image.shape
+    padded_height = _covering_length(height, tile_size, stride)
+    padded_width = _covering_length(width, tile_size, stride)
+
+    # Replicate the border instead of padding with black so edge tiles look like document content.
+    padded = F.pad(image.unsqueeze(0), (0, padded_width - width, 0, padded_height - height), mode='replicate')
+    columns = F.unfold(padded, kernel_size=tile_size, stride=stride)  # (1, C*T*T, N)
+    tiles = columns.transpose(1, 2).reshape(-1, channels, tile_size, tile_size)
+
+    layout = {
+        'size': (height, width),
+        'padded_size': (padded_height, padded_width),
+        'tile_size': tile_size,
+        'overlap': overlap,
+    }
+    return tiles, layout
+
+def blend_window(tile_size: int, overlap: int) -> torch.Tensor:
+    """Separable cosine window that ramps up over ``overlap`` pixels at each tile edge.
+
+    Ramps of neighbouring tiles sum to one inside the overlap, and the window is never
+    zero, so every pixel keeps a positive total weight after stitching.
+    """
+    ramp = torch.ones(tile_size)
+    if overlap > 0:
+        t = (torch.arange(overlap, dtype=torch.float32) + 0.5) / overlap
+        rise = 0.5 - 0.5 * torch.cos(math.pi * t)
+        ramp[:overlap] = rise
+        ramp[tile_size - overlap:] = rise.flip(0)
+    return ramp[:, None] * ramp[None, :]
+
+def stitch_tiles(tiles: torch.Tensor, layout: dict) -> torch.Tensor:
+    """Blends processed tiles back into a CHW image with one weighted fold pass."""
+    tile_size, overlap = layout['tile_size'], layout['overlap']
+    stride = tile_size - overlap
+    height, width = layout['size']
+    num_tiles, channels = tiles.shape[:2]
+
+    window = blend_window(tile_size, overlap).to(tiles)
+    columns = (tiles * window).reshape(num_tiles, channels * tile_size * tile_size).t().unsqueeze(0)
+    image = F.fold(columns, layout['padded_size'], kernel_size=tile_size, stride=stride)
+    weight_columns = window.reshape(1, -1, 1).repeat(1, 1, num_tiles)
+    weights = F.fold(weight_columns, layout['padded_size'], kernel_size=tile_size, stride=stride)
+    return (image / weights)[0, :, :height, :width]
 
 def tensor_to_pil(tensor_image: torch.Tensor, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)) -> Image.Image:
     """Converts a tensor image to a PIL Image, denormalizing it."""
@@ -93,14 +111,494 @@ def tensor_to_pil(tensor_image: torch.Tensor, mean=(0.5, 0.5, 0.5), std=(0.5, 0.
     pil_image = transforms.ToPILImage()(tensor_image)
     return pil_image
 
+def load_model(model_path: str, backend: str = 'eager', input_nc: int = 3, output_nc: int = 3,
+               device: torch.device = torch.device('cpu'), intra_op_threads: int = 0, inter_op_threads: int = 0,
+               optimize: bool = True, parallel_branches: bool = False):
+    """Loads the AtoB generator in eval mode for the selected backend.
+
+    ``eager`` builds ``models.AtoB`` and loads a state dict into it. ``torchscript`` loads a
+    frozen artifact written by export.py and does not import models.py at all.
+    ``onnxruntime`` opens an ONNX graph from export.py in a CPU session; the thread counts
+    only apply to it (0 keeps ONNX Runtime's defaults). With ``optimize`` the eager model is
+    rewritten by ``models.optimize_for_inference``. ``parallel_branches`` scripts the eager
+    model so its independent branches really run concurrently (torch.jit.fork is a no-op
+    outside TorchScript).
+    """
+    if backend == 'torchscript':
+        return torch.jit.load(model_path, map_location=device)
+
+    if backend == 'onnxruntime':
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        return ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+    # This assumes 'models.py' is in the same directory or accessible in PYTHONPATH.
+    try:
+        from models import AtoB, optimize_for_inference
+    except ImportError as e:
+        raise ImportError("Could not import 'AtoB' from 'models.py'. Make sure 'models.py' is accessible, "
+                          "or load an artifact from export.py with --backend torchscript.") from e
+    model = AtoB(input_nc, output_nc).to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    if optimize:
+        model = optimize_for_inference(model)
+    if parallel_branches:
+        model.parallel_branches = True
+        model = torch.jit.script(model)
+    return model
+
+def make_batch_runner(model, backend: str = 'eager', device: torch.device = torch.device('cpu')):
+    """Wraps a loaded model as a function from a CPU NCHW batch to the CPU output batch."""
+    if backend == 'onnxruntime':
+        input_name = model.get_inputs()[0].name
+
+        def run_batch(patch_batch: torch.Tensor) -> torch.Tensor:
+            return torch.from_numpy(model.run(None, {input_name: patch_batch.contiguous().numpy()})[0])
+        return run_batch
+
+    def run_batch(patch_batch: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return model(patch_batch.to(device)).cpu()
+    return run_batch
+
+class PatchBatchError(Exception):
+    """Raised when a model batch fails; carries the keys of the images it took down.
+
+    Images completed by earlier batches are kept and returned by the next ``add``/``flush``.
+    """
+
+    def __init__(self, keys, cause):
+        super().__init__(f"Batch failed for {len(keys)} image(s): {cause}")
+        self.keys = keys
+        self.cause = cause
+
+class PatchBatcher:
+    """Packs patches from consecutive images into model batches of a fixed size.
+
+    Patches are queued per image under a caller-chosen key. Whenever ``batch_size``
+    patches are pending (possibly spanning several small images) they are run through
+    ``run_batch`` as one tensor, and the outputs are routed back to their image. Images
+    are returned as ``(key, outputs)`` once all of their patches have been processed,
+    with ``outputs`` in the same order as the patches that were added.
+    """
+
+    def __init__(self, run_batch, batch_size: int):
+        self.run_batch = run_batch
+        self.batch_size = batch_size
+        self._pending = deque()  # (key, patches not yet sent to the model)
+        self._pending_count = 0
+        self._outputs = {}  # key -> processed output chunks
+        self._remaining = {}  # key -> number of patches still in flight
+        self._finished = []  # completed (key, outputs) not yet handed back
+
+    @property
+    def pending_patches(self) -> int:
+        """Patches queued but not yet sent to the model."""
+        return self._pending_count
+
+    def add(self, key, patches: torch.Tensor) -> list[tuple]:
+        """Queues the NCHW patches of one image and runs every batch that is now full."""
+        self._outputs[key] = []
+        self._remaining[key] = patches.size(0)
+        self._pending.append((key, patches))
+        self._pending_count += patches.size(0)
+
+        while self._pending_count >= self.batch_size:
+            self._run(self.batch_size)
+        return self._take_finished()
+
+    def flush(self) -> list[tuple]:
+        """Runs whatever is still pending, including a final partial batch."""
+        while self._pending_count > 0:
+            self._run(min(self.batch_size, self._pending_count))
+        return self._take_finished()
+
+    def _take_finished(self) -> list[tuple]:
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _run(self, n: int):
+        chunks, owners = [], []
+        taken = 0
+        while taken < n:
+            key, patches = self._pending[0]
+            take = min(n - taken, patches.size(0))
+            chunks.append(patches[:take])
+            owners.append((key, take))
+            if take == patches.size(0):
+                self._pending.popleft()
+            else:
+                self._pending[0] = (key, patches[take:])
+            taken += take
+        self._pending_count -= n
+
+        try:
+            outputs = self.run_batch(torch.cat(chunks) if len(chunks) > 1 else chunks[0])
+        except Exception as e:
+            self._drop(key for key, _ in owners)
+            raise PatchBatchError(list(dict.fromkeys(key for key, _ in owners)), e) from e
+
+        start = 0
+        for key, count in owners:
+            self._outputs[key].append(outputs[start:start + count])
+            start += count
+            self._remaining[key] -= count
+            if self._remaining[key] == 0:
+                del self._remaining[key]
+                parts = self._outputs.pop(key)
+                self._finished.append((key, torch.cat(parts) if len(parts) > 1 else parts[0]))
+
+    def _drop(self, keys):
+        """Forgets every image in ``keys``, including patches of theirs still pending."""
+        keys = set(keys)
+        for key in keys:
+            self._outputs.pop(key, None)
+            self._remaining.pop(key, None)
+        kept = deque((key, patches) for key, patches in self._pending if key not in keys)
+        self._pending_count = sum(patches.size(0) for _, patches in kept)
+        self._pending = kept
+
+
+def save_cleaned_image(context: dict, cleaned_tiles: torch.Tensor, output_dir_path: str) -> str:
+    """Stitches the cleaned tiles of one image and saves the result as PNG."""
+    final_cleaned_image = tensor_to_pil(stitch_tiles(cleaned_tiles, context['layout']))
+
+    base, ext = os.path.splitext(os.path.basename(context['path']))
+    output_filename = f"{base}_cleaned.png"
+    output_save_path = os.path.join(output_dir_path, output_filename)
+    final_cleaned_image.save(output_save_path)
+    return output_save_path
+
+class StageMonitor:
+    """Tracks queue depths and blocking time between the pipeline stages.
+
+    The model stage samples both queues every time it takes work. Time spent waiting
+    on an empty decode queue means decoding is the bottleneck; time spent waiting on a
+    full write queue means encoding is.
+    """
+
+    def __init__(self, decode_queue: queue.Queue, write_queue: queue.Queue):
+        self.queues = {'decode_q': decode_queue, 'write_q': write_queue}
+        self.depth_sums = {name: 0 for name in self.queues}
+        self.depth_max = {name: 0 for name in self.queues}
+        self.samples = 0
+        self.wait_decode = 0.0
+        self.wait_write = 0.0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start_time = time.time()
+
+    def sample(self):
+        self.samples += 1
+        for name, q in self.queues.items():
+            depth = q.qsize()
+            self.depth_sums[name] += depth
+            self.depth_max[name] = max(self.depth_max[name], depth)
+
+    def status_line(self) -> str:
+        depths = ' '.join(f"{name}={q.qsize()}/{q.maxsize}" for name, q in self.queues.items())
+        return f"[pipeline] {depths} model_wait_decode={self.wait_decode:.1f}s model_wait_write={self.wait_write:.1f}s"
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.start_time
+        lines = [f"Pipeline stats over {elapsed:.1f}s ({self.completed} cleaned, {self.failed} failed, {self.skipped} up to date):"]
+        for name, q in self.queues.items():
+            mean = self.depth_sums[name] / max(self.samples, 1)
+            lines.append(f"  {name}: mean depth {mean:.2f}, max {self.depth_max[name]} (capacity {q.maxsize})")
+        lines.append(f"  model stage waited {self.wait_decode:.1f}s for decoded images "
+                     f"(raise --decode_workers if large)")
+        lines.append(f"  model stage waited {self.wait_write:.1f}s for free writer slots "
+                     f"(raise --encode_workers if large)")
+        return '\n'.join(lines)
+
+
+_STOP = object()
+
+def run_pipeline(image_files, run_batch, output_dir_path: str, patch_size: int, overlap: int,
+                 batch_size: int, decode_workers: int = 2, encode_workers: int = 2, queue_size: int = 8,
+                 stats_interval: float = 10.0, manifest: Manifest = None, resume: bool = True) -> StageMonitor:
+    """Cleans ``image_files`` with a three-stage producer/consumer pipeline.
+
+    ``image_files`` may be any iterable of paths; decode threads pull from it lazily, so it
+    can be backed by a queue shared with other processes.
+
+    A pool of decode threads opens and tiles images into a bounded queue, the calling
+    thread batches tiles through ``run_batch``, and a pool of writer threads stitches,
+    encodes and saves the results.
+
+    With a ``manifest``, decode threads hash each input and, when ``resume`` is set, skip
+    the ones already cleaned with the same model. Every outcome is recorded in it.
+    """
+    path_iter = enumerate(image_files)
+    path_lock = threading.Lock()
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    monitor = StageMonitor(decode_queue, write_queue)
+    report_lock = threading.Lock()
+
+    def report_result(context, output_path=None, error=None):
+        if manifest is not None and 'input_hash' in context:
+            manifest.record(context['path'], context['input_hash'], output_path, error)
+        with report_lock:
+            if error is None:
+                monitor.completed += 1
+                print(f"Saved cleaned image to: {output_path}")
+            else:
+                monitor.failed += 1
+                print(f"Error processing {context['path']}: {error}")
+
+    def next_path():
+        with path_lock:
+            return next(path_iter, None)
+
+    def decode_worker():
+        while True:
+            item = next_path()
+            if item is None:
+                decode_queue.put(_STOP)
+                return
+            idx, img_path = item
+            context = {'path': img_path}
+            try:
+                with open(img_path, 'rb') as f:
+                    data = f.read()
+                if manifest is not None:
+                    context['input_hash'] = bytes_sha256(data)
+                    if resume and manifest.is_up_to_date(img_path, context['input_hash']):
+                        with report_lock:
+                            monitor.skipped += 1
+                            print(f"Skipping {img_path}: already cleaned with this model.")
+                        continue
+                image_tensor = image_to_tensor(Image.open(io.BytesIO(data)))
+                tiles, context['layout'] = extract_tiles(image_tensor, patch_size, overlap)
+            except Exception as e:
+                traceback.print_exc()
+                report_result(context, error=e)
+                continue
+            decode_queue.put((idx, context, tiles))
+
+    def encode_worker():
+        while True:
+            item = write_queue.get()
+            if item is _STOP:
+                return
+            context, cleaned_tiles = item
+            try:
+                output_save_path = save_cleaned_image(context, cleaned_tiles, output_dir_path)
+            except Exception as e:
+                traceback.print_exc()
+                report_result(context, error=e)
+                continue
+            report_result(context, output_save_path)
+
+    decoders = [threading.Thread(target=decode_worker, daemon=True) for _ in range(decode_workers)]
+    encoders = [threading.Thread(target=encode_worker, daemon=True) for _ in range(encode_workers)]
+    for thread in decoders + encoders:
+        thread.start()
+
+    batcher = PatchBatcher(run_batch, batch_size)
+    contexts = {}
+
+    def hand_off(finished):
+        for key, cleaned_tiles in finished:
+            wait_start = time.time()
+            write_queue.put((contexts.pop(key), cleaned_tiles))
+            monitor.wait_write += time.time() - wait_start
+
+    def drop_failed(e: PatchBatchError):
+        traceback.print_exception(e.cause)
+        for key in e.keys:
+            report_result(contexts.pop(key), error=e.cause)
+
+    decoders_running = decode_workers
+    last_status = time.time()
+    while decoders_running:
+        wait_start = time.time()
+        item = decode_queue.get()
+        monitor.wait_decode += time.time() - wait_start
+        monitor.sample()
+        if item is _STOP:
+            decoders_running -= 1
+            continue
+
+        idx, context, tiles = item
+        contexts[idx] = context
+        try:
+            hand_off(batcher.add(idx, tiles))
+        except PatchBatchError as e:
+            drop_failed(e)
+
+        if stats_interval > 0 and time.time() - last_status >= stats_interval:
+            print(monitor.status_line())
+            last_status = time.time()
+
+    while True:
+        try:
+            hand_off(batcher.flush())
+            break
+        except PatchBatchError as e:
+            drop_failed(e)
+
+    for _ in range(encode_workers):
+        write_queue.put(_STOP)
+    for thread in decoders + encoders:
+        thread.join()
+    return monitor
+
+def prepare_model(args, device: torch.device):
+    """Loads the model described by inference.py's ``args`` and quantizes it if requested."""
+    # Quantization works on the unmodified module, so only fp32 gets the inference rewrite.
+    model = load_model(args.model_path, args.backend, args.input_nc, args.output_nc, device,
+                       args.ort_intra_threads, args.ort_inter_threads,
+                       optimize=args.precision == 'fp32',
+                       parallel_branches=args.parallel_branches and args.precision == 'fp32')
+    print(f"Model loaded successfully from {args.model_path} ({args.backend} backend)")
+
+    if args.precision == 'int8':
+        from quantize import load_calibration_tiles, quantize_model, compare_models, format_report
+        calib_dir = args.calib_dir or args.input_dir
+        calib_tiles = load_calibration_tiles(calib_dir, args.patch_size, args.calib_images,
+                                             exclude_subdir=args.output_subdir_name)
+        print(f"Quantizing model to int8 ({args.quant_mode}) with {calib_tiles.size(0)} tiles from {calib_dir} ...")
+        quantized = quantize_model(model, args.quant_mode, calib_tiles)
+        print(format_report(compare_models(model, quantized, calib_tiles), f"int8 ({args.quant_mode})"))
+        model = quantized
+    return model
+
+def split_cpus(workers: int) -> list:
+    """Splits the CPUs this process may use into ``workers`` contiguous, disjoint sets."""
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = max(len(cpus) // workers, 1)
+    return [set(cpus[i * per_worker:(i + 1) * per_worker]) or {cpus[i % len(cpus)]} for i in range(workers)]
+
+def _inference_worker(worker_id: int, args, cpus, threads: int, path_queue, result_queue,
+                      manifest_entries: dict, fingerprint: str, output_dir_path: str):
+    """Entry point of one --workers process: its own model copy pulling paths from the shared queue."""
+    completed = failed = skipped = 0
+    error = None
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(threads)
+        model = prepare_model(args, torch.device('cpu'))
+        manifest = ForwardingManifest(manifest_entries, args.input_dir, fingerprint, result_queue)
+        monitor = run_pipeline(
+            iter(path_queue.get, None), make_batch_runner(model, args.backend), output_dir_path,
+            patch_size=args.patch_size, overlap=args.overlap, batch_size=args.batch_size,
+            decode_workers=args.decode_workers, encode_workers=args.encode_workers,
+            queue_size=args.queue_size, stats_interval=0, manifest=manifest, resume=not args.force,
+        )
+        completed, failed, skipped = monitor.completed, monitor.failed, monitor.skipped
+    except Exception as e:
+        traceback.print_exc()
+        error = str(e)
+    result_queue.put(('finished', worker_id, completed, failed, skipped, error))
+
+def run_workers(args, image_files: list[str], output_dir_path: str, manifest: Manifest) -> tuple[int, int]:
+    """Shards ``image_files`` over ``args.workers`` processes and records their results.
+
+    Each process gets ``--threads_per_worker`` torch threads and, with ``--pin_cpus``, its
+    own slice of the CPUs. Workers pull paths from one shared queue, so faster workers
+    simply take more images. Returns the number of cleaned and failed images.
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    path_queue = context.Queue()
+    result_queue = context.Queue()
+    for img_path in image_files:
+        path_queue.put(img_path)
+    for _ in range(args.workers):
+        path_queue.put(None)
+
+    cpu_sets = split_cpus(args.workers) if args.pin_cpus else [None] * args.workers
+    threads = args.threads_per_worker or max((os.cpu_count() or 1) // args.workers, 1)
+    print(f"Starting {args.workers} workers with {threads} torch threads each"
+          f"{' (pinned to separate CPUs)' if args.pin_cpus else ''}.")
+
+    processes = [
+        context.Process(target=_inference_worker, daemon=True, args=(
+            worker_id, args, cpu_sets[worker_id], threads, path_queue, result_queue,
+            manifest.entries, manifest.model_fingerprint, output_dir_path))
+        for worker_id in range(args.workers)
+    ]
+    start_time = time.time()
+    for process in processes:
+        process.start()
+
+    cleaned = failed = 0
+    reported = set()
+    last_status = time.time()
+    while len(reported) < len(processes):
+        try:
+            message = result_queue.get(timeout=1.0)
+        except queue.Empty:
+            for worker_id, process in enumerate(processes):
+                if worker_id not in reported and not process.is_alive():
+                    print(f"Worker {worker_id} exited unexpectedly (exit code {process.exitcode}).")
+                    reported.add(worker_id)
+            continue
+
+        if message[0] == 'record':
+            _, img_path, input_hash, output_path, error = message
+            manifest.record(img_path, input_hash, output_path, error)
+            if error is None:
+                cleaned += 1
+            else:
+                failed += 1
+        else:
+            _, worker_id, completed, worker_failed, skipped, error = message
+            reported.add(worker_id)
+            status = f"failed to start: {error}" if error else f"{completed} cleaned, {worker_failed} failed, {skipped} up to date"
+            print(f"Worker {worker_id} finished: {status}")
+
+        if args.stats_interval > 0 and time.time() - last_status >= args.stats_interval:
+            elapsed = time.time() - start_time
+            print(f"[workers] {cleaned} cleaned in {elapsed:.1f}s ({cleaned / elapsed:.2f} images/sec)")
+            last_status = time.time()
+
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start_time
+    print(f"Aggregate: {cleaned} images cleaned, {failed} failed in {elapsed:.1f}s "
+          f"({cleaned / max(elapsed, 1e-9):.2f} images/sec with {args.workers} workers x {threads} threads)")
+    return cleaned, failed
+
 def main():
     parser = argparse.ArgumentParser(description='Inference script for document image cleaning using CycleGAN.')
     parser.add_argument('--input_dir', type=str, required=True, help='Directory containing input document images.')
     parser.add_argument('--output_subdir_name', type=str, default='cleaned_output', help='Name of the subdirectory within input_dir to save cleaned images.')
-    parser.add_argument('--model_path', type=str, default='Output/S-color0.5/model/netG_A2B.pth', help='Path to the pre-trained generator model (netG_A2B).')
+    parser.add_argument('--model_path', type=str, default='Output/S-color0.5/model/netG_A2B.pth', help='Path to the pre-trained generator model (netG_A2B), or to an exported artifact for non-eager backends.')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnxruntime'], help='eager: build AtoB from models.py and load a state dict; torchscript / onnxruntime: load an artifact written by export.py.')
+    parser.add_argument('--parallel_branches', action='store_true', help='eager backend: script the model and run its independent De_predict/De_remove branches concurrently.')
+    parser.add_argument('--ort_intra_threads', type=int, default=0, help='ONNX Runtime intra-op threads (0 = ONNX Runtime default).')
+    parser.add_argument('--ort_inter_threads', type=int, default=0, help='ONNX Runtime inter-op threads (0 = ONNX Runtime default).')
     parser.add_argument('--patch_size', type=int, default=256, help='Size of the image patches (e.g., 256 for 256x256).')
+    parser.add_argument('--overlap', type=int, default=32, help='Pixels shared by neighbouring patches; overlaps are blended to hide seams.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'int8'], help='int8 quantizes the eager model for CPU inference and prints its accuracy against fp32 first.')
+    parser.add_argument('--quant_mode', type=str, default='static', choices=['dynamic', 'static'], help='int8 quantization mode. static calibrates activation ranges on --calib_dir.')
+    parser.add_argument('--calib_dir', type=str, default=None, help='Sample documents for int8 calibration and the accuracy report (default: --input_dir).')
+    parser.add_argument('--calib_images', type=int, default=8, help='Maximum number of images used for int8 calibration.')
     parser.add_argument('--input_nc', type=int, default=3, help='Number of channels of input data for the model.')
     parser.add_argument('--output_nc', type=int, default=3, help='Number of channels of output data for the model.')
+    parser.add_argument('--batch_size', type=int, default=16, help='Number of patches per model call. Patches from consecutive images are packed together.')
+    parser.add_argument('--decode_workers', type=int, default=2, help='Threads that decode and tile input images.')
+    parser.add_argument('--encode_workers', type=int, default=2, help='Threads that stitch, encode and save cleaned images.')
+    parser.add_argument('--queue_size', type=int, default=8, help='Capacity (in images) of the queues between pipeline stages.')
+    parser.add_argument('--stats_interval', type=float, default=10.0, help='Seconds between pipeline queue-depth reports (0 disables them).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of CPU worker processes, each with its own model copy, sharing one queue of images.')
+    parser.add_argument('--threads_per_worker', type=int, default=0, help='torch threads per worker process (0 = CPU count divided by --workers).')
+    parser.add_argument('--pin_cpus', action='store_true', help='Pin each worker process to its own disjoint set of CPUs.')
+    parser.add_argument('--force', action='store_true', help='Reprocess every image, even those the manifest marks as already cleaned with this model.')
+    parser.add_argument('--profile', action='store_true', help='Time every submodule of the eager model and write a table plus a Chrome trace (profile_trace.json) to the output folder.')
     parser.add_argument('--cuda', action='store_true', help='Use GPU computation if available.')
     
     args = parser.parse_args()
@@ -109,6 +607,38 @@ def main():
         print("Error: --patch_size must be a positive integer.")
         return
 
+    if not 0 <= args.overlap <= args.patch_size // 2:
+        print("Error: --overlap must be between 0 and half of --patch_size.")
+        return
+
+    if args.batch_size <= 0:
+        print("Error: --batch_size must be a positive integer.")
+        return
+
+    if min(args.decode_workers, args.encode_workers, args.queue_size, args.workers) <= 0:
+        print("Error: --decode_workers, --encode_workers, --queue_size and --workers must be positive integers.")
+        return
+
+    if args.precision == 'int8' and args.backend != 'eager':
+        print("Error: --precision int8 quantizes the eager model; quantize.py --output writes an int8 TorchScript artifact instead.")
+        return
+
+    if args.precision == 'int8' and args.cuda:
+        print("int8 inference runs on CPU only; ignoring --cuda.")
+        args.cuda = False
+
+    if args.backend == 'onnxruntime' and args.cuda:
+        print("The onnxruntime backend uses the CPU execution provider; ignoring --cuda.")
+        args.cuda = False
+
+    if args.profile and (args.backend != 'eager' or args.parallel_branches or args.workers > 1):
+        print("Error: --profile hooks the eager model in this process; it cannot be combined with --backend torchscript/onnxruntime, --parallel_branches or --workers.")
+        return
+
+    if args.workers > 1 and args.cuda:
+        print("--workers runs one model copy per CPU process; ignoring --cuda.")
+        args.cuda = False
+
     if args.cuda and torch.cuda.is_available():
         device = torch.device('cuda')
         print("CUDA selected and available. Using GPU.")
@@ -123,19 +653,13 @@ def main():
         print(f"Error: Model file not found at {args.model_path}")
         return
 
-    try:
-        model = AtoB(args.input_nc, args.output_nc).to(device)
-        model.load_state_dict(torch.load(args.model_path, map_location=device))
-        model.eval() 
-        print(f"Model loaded successfully from {args.model_path}")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        return
-
-    transform_patch = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
-    ])
+    # With --workers, each worker process loads its own copy of the model.
+    if args.workers == 1:
+        try:
+            model = prepare_model(args, device)
+        except Exception as e:
+            print(f"Error loading model: {e}")
+            return
 
     output_dir_path = os.path.join(args.input_dir, args.output_subdir_name)
     os.makedirs(output_dir_path, exist_ok=True)
@@ -148,47 +672,35 @@ def main():
     
     print(f"Found {len(image_files)} images to process.")
 
-    for img_path in image_files:
-        print(f"Processing: {img_path} ...")
+    fingerprint = model_fingerprint(
+        args.model_path, patch_size=args.patch_size, overlap=args.overlap,
+        input_nc=args.input_nc, output_nc=args.output_nc, backend=args.backend,
+        precision=args.precision, quant_mode=args.quant_mode if args.precision == 'int8' else None,
+    )
+    manifest = Manifest(output_dir_path, args.input_dir, fingerprint)
+    if args.workers > 1:
         try:
-            original_pil_image = Image.open(img_path).convert('RGB')
-            
-            padded_pil_image, (orig_w, orig_h) = pad_image_to_patch_size(original_pil_image, args.patch_size)
-            
-            patches_info_list = create_patches_from_image(padded_pil_image, args.patch_size)
-            
-            processed_patches_for_stitching = []
-
-            with torch.no_grad():
-                for patch_info in patches_info_list:
-                    pil_patch = patch_info['image_pil']
-                    patch_tensor = transform_patch(pil_patch).unsqueeze(0).to(device)
-                    cleaned_patch_tensor = model(patch_tensor)
-                    cleaned_pil_patch = tensor_to_pil(cleaned_patch_tensor)
-                    processed_patches_for_stitching.append({
-                        'image_pil': cleaned_pil_patch,
-                        'coords': patch_info['coords']
-                    })
-            
-            stitched_padded_image = stitch_patches_to_image(
-                processed_patches_for_stitching,
-                padded_pil_image.width,
-                padded_pil_image.height
-            )
-            
-            final_cleaned_image = unpad_image(stitched_padded_image, orig_w, orig_h)
-            
-            base, ext = os.path.splitext(os.path.basename(img_path))
-            output_filename = f"{base}_cleaned.png"
-            output_save_path = os.path.join(output_dir_path, output_filename)
-            final_cleaned_image.save(output_save_path)
-            print(f"Saved cleaned image to: {output_save_path}")
-
-        except Exception as e:
-            print(f"Error processing {img_path}: {e}")
-            import traceback
-            traceback.print_exc()
+            run_workers(args, image_files, output_dir_path, manifest)
+        finally:
+            manifest.close()
+        print("Inference complete.")
+        return
 
+    profiler = ModuleProfiler(model).attach() if args.profile else None
+    try:
+        monitor = run_pipeline(
+            image_files, make_batch_runner(model, args.backend, device), output_dir_path,
+            patch_size=args.patch_size, overlap=args.overlap, batch_size=args.batch_size,
+            decode_workers=args.decode_workers, encode_workers=args.encode_workers,
+            queue_size=args.queue_size, stats_interval=args.stats_interval,
+            manifest=manifest, resume=not args.force,
+        )
+    finally:
+        manifest.close()
+    print(monitor.summary())
+    if profiler is not None:
+        profiler.detach()
+        print(profiler.report(os.path.join(output_dir_path, 'profile_trace.json')))
     print("Inference complete.")
 
 if __name__ == '__main__':
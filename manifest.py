@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+def bytes_sha256(data: bytes) -> str:
+    """Hex SHA-256 digest of an in-memory buffer."""
+    return hashlib.sha256(data).hexdigest()
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """Hex SHA-256 digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def model_fingerprint(model_path: str, **settings) -> str:
+    """Identifies a model checkpoint plus every setting that changes the cleaned output."""
+    payload = json.dumps({'checkpoint': file_sha256(model_path), **settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class Manifest:
+    """Append-only JSONL record of which inputs were cleaned with which model.
+
+    Each line stores an input (relative to the input directory), its content hash, the
+    model fingerprint, and whether it was cleaned or failed. The last line for an input
+    wins. An input is up to date when its content hash and the model fingerprint both
+    match and the output file still exists; anything else is reprocessed. A truncated
+    last line left by a crash is ignored, and the file is compacted when opened.
+    """
+
+    def __init__(self, output_dir: str, input_dir: str, model_fingerprint: str):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.input_dir = input_dir
+        self.model_fingerprint = model_fingerprint
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['input']] = entry
+        if lines > len(self.entries):
+            self._compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def key(self, input_path: str) -> str:
+        return os.path.relpath(input_path, self.input_dir)
+
+    def is_up_to_date(self, input_path: str, input_hash: str) -> bool:
+        entry = self.entries.get(self.key(input_path))
+        return (entry is not None
+                and entry['status'] == 'done'
+                and entry['input_hash'] == input_hash
+                and entry['model'] == self.model_fingerprint
+                and os.path.exists(entry['output']))
+
+    def record(self, input_path: str, input_hash: str, output_path: str = None, error=None):
+        """Appends the outcome for one input and syncs it to disk."""
+        input_key = self.key(input_path)
+        entry = {
+            'input': input_key,
+            'input_hash': input_hash,
+            'model': self.model_fingerprint,
+            'status': 'done' if error is None else 'failed',
+            'output': output_path,
+            'error': None if error is None else str(error),
+            'time': time.time(),
+        }
+        with self._lock:
+            self.entries[input_key] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class ForwardingManifest(Manifest):
+    """Manifest for worker processes: checks against a snapshot and forwards every record.
+
+    Only the parent process owns the manifest file. Workers receive a copy of its entries
+    to decide what to skip and put ``('record', ...)`` messages on ``result_queue``, which
+    the parent writes with ``Manifest.record``.
+    """
+
+    def __init__(self, entries: dict, input_dir: str, model_fingerprint: str, result_queue):
+        self.input_dir = input_dir
+        self.model_fingerprint = model_fingerprint
+        self.entries = entries
+        self.result_queue = result_queue
+
+    def record(self, input_path: str, input_hash: str, output_path: str = None, error=None):
+        self.result_queue.put(('record', input_path, input_hash, output_path,
+                               None if error is None else str(error)))
+
+    def close(self):
+        pass
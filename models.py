@@ -2,9 +2,12 @@
 # -*- coding: UTF-8 -*-
 # -*- coding: gbk -*-
 
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 ##########################################################################
 
@@ -12,6 +15,28 @@ def default_conv(in_channels, out_channels, kernel_size, bias=True):
     return nn.Conv2d(in_channels, out_channels, kernel_size, padding=(kernel_size // 2), bias=bias)  
 
 
+class CheckpointedModule(nn.Module):
+    """Base for blocks that support activation checkpointing (see set_checkpointing).
+
+    Subclasses implement ``_forward(x)``. With ``use_checkpoint`` set, training-mode
+    calls recompute the block's activations in backward instead of storing them;
+    scripted models always run ``_forward`` directly.
+    """
+
+    def __init__(self):
+        super(CheckpointedModule, self).__init__()
+        self.use_checkpoint = False
+
+    def forward(self, x):
+        if self.use_checkpoint and self.training and not torch.jit.is_scripting():
+            return self._checkpointed_forward(x)
+        return self._forward(x)
+
+    @torch.jit.unused
+    def _checkpointed_forward(self, x):
+        return checkpoint(self._forward, x, use_reentrant=False)
+
+
 class PALayer(nn.Module):
     def __init__(self, channel):
         super(PALayer, self).__init__()
@@ -67,7 +92,7 @@ class FAM(nn.Module):
         res += x
         return res
 
-class TFAM(nn.Module):
+class TFAM(CheckpointedModule):
     def __init__(self, conv, dim, kernel_size, blocks):
         super(TFAM, self).__init__()
         modules = [FAM(conv, dim, kernel_size) for _ in range(blocks)]
@@ -77,14 +102,14 @@ class TFAM(nn.Module):
         self.gp = nn.Sequential(*modules)
         
 
-    def forward(self, x):
+    def _forward(self, x):
         res = self.gp(x)
         res += x
         return res
 
 
 
-class De_remove(nn.Module):
+class De_remove(CheckpointedModule):
     def __init__(self, gps, blocks, conv=default_conv):
         super(De_remove, self).__init__()
         self.gps = gps
@@ -111,7 +136,7 @@ class De_remove(nn.Module):
         self.pre = nn.Sequential(*pre_process)
         self.post = nn.Sequential(*post_precess)
 
-    def forward(self, x1):
+    def _forward(self, x1):
         x = self.pre(x1)
         res1 = self.g1(x)
         res2 = self.g2(res1)
@@ -132,7 +157,7 @@ class De_remove(nn.Module):
 ##########################################################################
 
 
-class Re_pretict(nn.Module):
+class Re_pretict(CheckpointedModule):
     def __init__(self, channels, num_of_layers=15):
         super(Re_pretict, self).__init__()
         kernel_size = 3
@@ -179,7 +204,7 @@ class Re_pretict(nn.Module):
                                 groups=groups, bias=bias))
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def _forward(self, x):
         input = x
         x1 = self.conv1_1(x)
         x1 = self.conv1_2(x1)
@@ -203,7 +228,7 @@ class Re_pretict(nn.Module):
 ##########################################################################
 
 
-class De_predict(nn.Module):
+class De_predict(CheckpointedModule):
     def __init__(self, channels, num_of_layers=15):
         super(De_predict, self).__init__()
         kernel_size = 3
@@ -249,7 +274,7 @@ class De_predict(nn.Module):
                                 groups=groups, bias=bias))
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def _forward(self, x):
         input = x
         x1 = self.conv1_1(x)
         x1 = self.conv1_2(x1)
@@ -299,8 +324,8 @@ class ContextBlock(nn.Module):
         context_mask = self.conv_mask(x)
         # [N, 1, H * W]
         context_mask = context_mask.view(batch, 1, height * width)
-        # [N, 1, H * W]
-        context_mask = self.softmax(context_mask)
+        # [N, 1, H * W], in fp32 under mixed precision: the sum over H * W overflows fp16
+        context_mask = self.softmax(context_mask.float()).type_as(input_x)
         # [N, 1, H * W, 1]
         context_mask = context_mask.unsqueeze(3)
         # [N, 1, C, 1]
@@ -323,7 +348,7 @@ class ContextBlock(nn.Module):
 ##########################################################################
 #CAB
 ##########################################################################
-class ResidualBlock(nn.Module):
+class ResidualBlock(CheckpointedModule):
     def __init__(self, in_features):
         super(ResidualBlock, self).__init__()
 
@@ -340,7 +365,7 @@ class ResidualBlock(nn.Module):
         self.act = act
         
         self.gcnet = ContextBlock(in_features)
-    def forward(self, x):
+    def _forward(self, x):
         res = self.conv_block(x)
         res = self.act(self.gcnet(res))
         res += x
@@ -351,8 +376,11 @@ class ResidualBlock(nn.Module):
 
 ##########################################################################
 class AtoB(nn.Module):
-    def __init__(self, input_nc, output_nc, n_residual_blocks=9):
+    def __init__(self, input_nc, output_nc, n_residual_blocks=9, parallel_branches=False):
         super(AtoB, self).__init__()
+        # Run Dep and Der concurrently. torch.jit.fork only runs asynchronously in TorchScript,
+        # so this takes effect once the model is scripted (export.py); eager runs them in turn.
+        self.parallel_branches = parallel_branches
         f1 = [nn.ReflectionPad2d(3),
                  nn.Conv2d(input_nc, 64, 7),
                  nn.InstanceNorm2d(64),
@@ -415,8 +443,13 @@ class AtoB(nn.Module):
         self.f8 = nn.Sequential(*f8)
         
     def forward(self, x):
-        xa1 = self.Dep(x)
-        xa2 = self.Der(x)
+        if self.parallel_branches:
+            future = torch.jit.fork(self.Der, x)
+            xa1 = self.Dep(x)
+            xa2 = torch.jit.wait(future)
+        else:
+            xa1 = self.Dep(x)
+            xa2 = self.Der(x)
         result = torch.cat([xa1, xa2], dim=1)
         result = self.f8(result)
         x1 = self.f1(result)
@@ -434,8 +467,10 @@ class AtoB(nn.Module):
 ##########################################################################
 ##########################################################################
 class BtoA(nn.Module):
-    def __init__(self, input_nc, output_nc, n_residual_blocks=9):
+    def __init__(self, input_nc, output_nc, n_residual_blocks=9, parallel_branches=False):
         super(BtoA, self).__init__()
+        # Run AD concurrently with the trunk (TorchScript only, see AtoB).
+        self.parallel_branches = parallel_branches
         f1 = [nn.ReflectionPad2d(3),
                  nn.Conv2d(input_nc, 64, 7),
                  nn.InstanceNorm2d(64),
@@ -492,7 +527,17 @@ class BtoA(nn.Module):
         self.f7 = nn.Sequential(*f7)
         self.AD = Re_pretict(channels=3)
     def forward(self, x):
-        xa1 = self.AD(x)
+        if self.parallel_branches:
+            future = torch.jit.fork(self.AD, x)
+            x7 = self.trunk(x)
+            xa1 = torch.jit.wait(future)
+        else:
+            xa1 = self.AD(x)
+            x7 = self.trunk(x)
+        x7 = x7 + xa1
+        return x7 
+
+    def trunk(self, x):
         x1 = self.f1(x)
         x2 = self.f2(x1)
         x3 = self.f3(x2)
@@ -503,8 +548,7 @@ class BtoA(nn.Module):
         x6 = self.f6(x5)
         x6 = x6 + x1
         x7 = self.f7(x6)
-        x7 = x7 + xa1
-        return x7 
+        return x7
 ##########################################################################
 ##########################################################################
 ##########################################################################
@@ -584,7 +628,118 @@ class Discriminator(nn.Module):
 ##########################################################################
 ##########################################################################
 ##########################################################################
-if __name__ == "__main__":
-    net1 = Generator(input_nc=3, output_nc=3)
-    print(net1)
+# Activation checkpointing
+##########################################################################
+CHECKPOINT_POLICIES = {
+    'tfam': (TFAM,),
+    'branch': (De_remove, De_predict, Re_pretict),
+    'residual': (ResidualBlock,),
+}
+
+def set_checkpointing(model, policies):
+    """Enables activation checkpointing on the blocks named by ``policies`` (keys of CHECKPOINT_POLICIES).
+
+    Checkpointed blocks keep only their input during the forward pass and recompute
+    their activations in backward: less memory for more compute. It only applies in
+    training mode and never to scripted or exported models.
+    """
+    types = tuple(t for policy in policies for t in CHECKPOINT_POLICIES[policy])
+    for module in model.modules():
+        if isinstance(module, CheckpointedModule):
+            module.use_checkpoint = isinstance(module, types)
+    return model
+
+##########################################################################
+# Mixed-precision training
+##########################################################################
+class FP32InstanceNorm2d(nn.InstanceNorm2d):
+    """InstanceNorm2d that computes its statistics in fp32 and returns the input dtype."""
 
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super(FP32InstanceNorm2d, self).forward(x.float()).type_as(x)
+
+def use_fp32_norms(model):
+    """Switches every InstanceNorm2d of ``model`` to FP32InstanceNorm2d in place (for --amp)."""
+    for module in model.modules():
+        if type(module) is nn.InstanceNorm2d:
+            module.__class__ = FP32InstanceNorm2d
+    return model
+
+##########################################################################
+# Inference-time graph rewrites
+##########################################################################
+def _fold_reflection_pad(pad, conv):
+    """Merges ReflectionPad2d -> unpadded Conv2d into one Conv2d with padding_mode='reflect'."""
+    if type(conv) is not nn.Conv2d or conv.padding_mode != 'zeros' or any(conv.padding):
+        return None
+    if len(set(pad.padding)) != 1:
+        return None
+    folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                       padding=pad.padding[0], dilation=conv.dilation, groups=conv.groups,
+                       bias=conv.bias is not None, padding_mode='reflect')
+    folded.weight = conv.weight
+    folded.bias = conv.bias
+    return folded
+
+
+def _rewrite_sequential(seq):
+    layers = [layer for layer in seq if not isinstance(layer, (nn.Dropout, nn.Dropout2d))]
+    rewritten = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        if isinstance(layer, nn.ReflectionPad2d) and i + 1 < len(layers):
+            folded = _fold_reflection_pad(layer, layers[i + 1])
+            if folded is not None:
+                rewritten.append(folded)
+                i += 2
+                continue
+        # The previous layer's output is only consumed here, so it can be overwritten.
+        if isinstance(layer, (nn.ReLU, nn.LeakyReLU)) and rewritten:
+            layer.inplace = True
+        rewritten.append(layer)
+        i += 1
+    return nn.Sequential(*rewritten)
+
+
+def _rewrite_for_inference(module):
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.Sequential):
+            child = _rewrite_sequential(child)
+            setattr(module, name, child)
+        elif isinstance(child, (nn.Dropout, nn.Dropout2d)):
+            child = nn.Identity()
+            setattr(module, name, child)
+        _rewrite_for_inference(child)
+
+
+def optimize_for_inference(model, channels_last=True):
+    """Returns an eval-mode copy of a loaded generator rewritten into a leaner equivalent module.
+
+    Dropout layers are removed, ReflectionPad2d + Conv2d pairs become a single reflect-padded
+    Conv2d, activations that directly follow another layer run in place, and weights are
+    stored channels_last for oneDNN. Kernel-level conv + activation fusion is left to
+    torch.jit.freeze (see export.py). Sequential indices change, so load checkpoints first.
+    """
+    model = copy.deepcopy(model).eval()
+    _rewrite_for_inference(model)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def check_inference_equivalence(model, size=64, batch=2, atol=1e-4, channels_last=True):
+    """Compares a model against its optimize_for_inference() rewrite on random input."""
+    model = model.eval()
+    optimized = optimize_for_inference(model, channels_last=channels_last)
+    x = torch.randn(batch, 3, size, size)
+    with torch.no_grad():
+        max_abs_diff = (optimized(x) - model(x)).abs().max().item()
+    return max_abs_diff <= atol, max_abs_diff
+##########################################################################
+##########################################################################
+if __name__ == "__main__":
+    for name, net in [('AtoB', AtoB(3, 3)), ('BtoA', BtoA(3, 3)), ('S', S(3, 3))]:
+        ok, max_abs_diff = check_inference_equivalence(net)
+        print(f"{name}: optimize_for_inference max abs diff {max_abs_diff:.2e} -> {'OK' if ok else 'MISMATCH'}")
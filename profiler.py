@@ -0,0 +1,171 @@
+import json
+import time
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+def _tensors(value) -> list:
+    """Flattens the tensors out of a module input or output (tensor, tuple, list or dict)."""
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [t for v in value for t in _tensors(v)]
+    if isinstance(value, dict):
+        return [t for v in value.values() for t in _tensors(v)]
+    return []
+
+class _ModuleStats:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.calls = 0
+        self.forward_s = 0.0
+        self.backward_calls = 0
+        self.backward_s = 0.0
+        self.activation_bytes = 0
+
+class ModuleProfiler:
+    """Per-module call counts, wall time and activation bytes collected with hooks.
+
+    Forward time is measured between a forward pre-hook and a forward hook on every
+    submodule, so it is inclusive of children. Backward time runs from the moment the
+    gradient of a module's output is ready until the gradient of its input is; plain
+    tensor hooks are used because module backward hooks clash with the in-place
+    activations in models.py. Inputs that do not require grad (e.g. the first layer)
+    give no backward time. With ``sync_cuda`` the device is synchronized in every hook,
+    which slows the run down but makes GPU timings meaningful.
+
+    Use it as a context manager, or call attach()/detach() around the profiled steps.
+    """
+
+    def __init__(self, models, sync_cuda: bool = True, max_events: int = 200000):
+        if isinstance(models, nn.Module):
+            models = {type(models).__name__: models}
+        self.models = models
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self._handles = []
+        self._origin = time.perf_counter()
+
+    def _now(self) -> float:
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _add_event(self, name: str, category: str, start: float, end: float):
+        if len(self.events) < self.max_events:
+            self.events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': 0,
+                'tid': 0 if category == 'forward' else 1,
+                'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+            })
+
+    def attach(self):
+        for prefix, model in self.models.items():
+            for name, module in model.named_modules():
+                full_name = f"{prefix}.{name}" if name else prefix
+                self.stats[full_name] = _ModuleStats(type(module).__name__)
+                self._handles.append(module.register_forward_pre_hook(self._make_pre_hook(full_name)))
+                self._handles.append(module.register_forward_hook(self._make_hook(full_name)))
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def _make_pre_hook(self, name: str):
+        def pre_hook(module, inputs):
+            call = {'start': self._now(), 'backward_start': None}
+            module.__dict__.setdefault('_profiler_calls', []).append(call)
+            if torch.is_grad_enabled():
+                grad_inputs = [t for t in _tensors(inputs) if t.requires_grad]
+                if grad_inputs:
+                    # Fires once the gradient w.r.t. the input has been computed: backward is done.
+                    grad_inputs[0].register_hook(self._make_backward_end(name, call))
+        return pre_hook
+
+    def _make_hook(self, name: str):
+        def hook(module, inputs, output):
+            end = self._now()
+            call = module._profiler_calls.pop()
+            stats = self.stats[name]
+            stats.calls += 1
+            stats.forward_s += end - call['start']
+            outputs = _tensors(output)
+            stats.activation_bytes += sum(t.numel() * t.element_size() for t in outputs)
+            self._add_event(name, 'forward', call['start'], end)
+            grad_outputs = [t for t in outputs if t.requires_grad]
+            if grad_outputs:
+                # Fires when the gradient w.r.t. the output arrives: backward through the module starts.
+                grad_outputs[0].register_hook(self._make_backward_start(call))
+        return hook
+
+    def _make_backward_start(self, call: dict):
+        def backward_start(grad):
+            call['backward_start'] = self._now()
+        return backward_start
+
+    def _make_backward_end(self, name: str, call: dict):
+        def backward_end(grad):
+            if call['backward_start'] is None:
+                return
+            end = self._now()
+            stats = self.stats[name]
+            stats.backward_calls += 1
+            stats.backward_s += end - call['backward_start']
+            self._add_event(name, 'backward', call['backward_start'], end)
+        return backward_end
+
+    def rows(self) -> list[dict]:
+        """Per-module totals, most expensive (forward + backward) first."""
+        rows = [{
+            'module': name, 'type': s.kind, 'calls': s.calls,
+            'forward_ms': s.forward_s * 1000, 'backward_ms': s.backward_s * 1000,
+            'activation_mb': s.activation_bytes / 2 ** 20,
+        } for name, s in self.stats.items() if s.calls]
+        return sorted(rows, key=lambda r: r['forward_ms'] + r['backward_ms'], reverse=True)
+
+    def table(self, max_rows: int = 40) -> str:
+        """Text table of the most expensive modules; times are inclusive of submodules."""
+        lines = [f"{'module':60s} {'type':18s} {'calls':>7s} {'fwd ms':>11s} {'bwd ms':>11s} {'act MB':>10s}"]
+        for row in self.rows()[:max_rows]:
+            lines.append(f"{row['module'][:60]:60s} {row['type'][:18]:18s} {row['calls']:7d} "
+                         f"{row['forward_ms']:11.2f} {row['backward_ms']:11.2f} {row['activation_mb']:10.1f}")
+        return '\n'.join(lines)
+
+    def type_table(self) -> str:
+        """Totals per module type, e.g. all ConvTranspose2d together; container types include their children."""
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for name, s in self.stats.items():
+            total = totals[s.kind]
+            total[0] += s.calls
+            total[1] += s.forward_s * 1000
+            total[2] += s.backward_s * 1000
+        lines = [f"{'type':24s} {'calls':>7s} {'fwd ms':>11s} {'bwd ms':>11s}"]
+        for kind, (calls, fwd, bwd) in sorted(totals.items(), key=lambda kv: kv[1][1] + kv[1][2], reverse=True):
+            if calls:
+                lines.append(f"{kind[:24]:24s} {calls:7d} {fwd:11.2f} {bwd:11.2f}")
+        return '\n'.join(lines)
+
+    def save_chrome_trace(self, path: str):
+        """Writes the recorded calls as a Chrome trace (open in chrome://tracing or Perfetto)."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def report(self, trace_path: str = None, max_rows: int = 40) -> str:
+        """Both tables as one string; also writes the Chrome trace when ``trace_path`` is given."""
+        if trace_path:
+            self.save_chrome_trace(trace_path)
+        text = self.table(max_rows) + '\n\n' + self.type_table()
+        if trace_path:
+            text += f"\n\nChrome trace written to: {trace_path}"
+        return text
@@ -0,0 +1,139 @@
+import argparse
+import copy
+import math
+import os
+import time
+
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from inference import get_image_paths, image_to_tensor, extract_tiles, load_model
+
+def load_calibration_tiles(calib_dir: str, patch_size: int, max_images: int = 8,
+                           exclude_subdir: str = None) -> torch.Tensor:
+    """Cuts up to ``max_images`` sample documents into non-overlapping model-sized tiles."""
+    image_paths = sorted(get_image_paths(calib_dir, exclude_subdir=exclude_subdir))[:max_images]
+    if not image_paths:
+        raise ValueError(f"No calibration images found in {calib_dir}.")
+    tiles = [extract_tiles(image_to_tensor(Image.open(path)), patch_size, 0)[0] for path in image_paths]
+    return torch.cat(tiles)
+
+def quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    """Quantizes conv weights to int8 ahead of time; activations are quantized on the fly.
+
+    PyTorch's default dynamic mapping only covers Linear and RNN layers, none of which
+    AtoB has, so convolutions are mapped to the dynamic quantized Conv2d explicitly.
+    """
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+    import torch.ao.nn.quantized.dynamic as nnqd
+
+    return quantize_dynamic(
+        copy.deepcopy(model).cpu().eval(),
+        qconfig_spec={nn.Conv2d: default_dynamic_qconfig},
+        mapping={nn.Conv2d: nnqd.Conv2d},
+    )
+
+def quantize_static_int8(model: nn.Module, calib_tiles: torch.Tensor, batch_size: int = 8) -> nn.Module:
+    """Post-training static int8 quantization with FX graph mode.
+
+    Observers are inserted into a copy of ``model``, calibrated on ``calib_tiles`` and then
+    converted to quantized kernels. Ops without an int8 kernel (e.g. the ContextBlock
+    matmul) stay in fp32 with (de)quantization around them.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    backend = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(calib_tiles[:1],))
+    with torch.no_grad():
+        for start in range(0, calib_tiles.size(0), batch_size):
+            prepared(calib_tiles[start:start + batch_size])
+    return convert_fx(prepared)
+
+def quantize_model(model: nn.Module, mode: str, calib_tiles: torch.Tensor = None) -> nn.Module:
+    if mode == 'dynamic':
+        return quantize_dynamic_int8(model)
+    if mode == 'static':
+        if calib_tiles is None:
+            raise ValueError("Static quantization needs calibration tiles.")
+        return quantize_static_int8(model, calib_tiles)
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+def compare_models(reference: nn.Module, candidate: nn.Module, tiles: torch.Tensor, batch_size: int = 8) -> dict:
+    """Runs both models on ``tiles`` and measures how far the candidate drifts.
+
+    PSNR and max abs diff are computed on images mapped back to [0, 1], so a max abs
+    diff of 1/255 is one 8-bit grey level.
+    """
+    psnrs, max_abs_diff = [], 0.0
+    reference_time = candidate_time = 0.0
+    with torch.no_grad():
+        for start in range(0, tiles.size(0), batch_size):
+            batch = tiles[start:start + batch_size]
+            t0 = time.time()
+            expected = reference(batch)
+            t1 = time.time()
+            actual = candidate(batch)
+            t2 = time.time()
+            reference_time += t1 - t0
+            candidate_time += t2 - t1
+
+            expected = (expected * 0.5 + 0.5).clamp(0, 1)
+            actual = (actual * 0.5 + 0.5).clamp(0, 1)
+            diff = (actual - expected).abs()
+            max_abs_diff = max(max_abs_diff, diff.max().item())
+            mse = diff.pow(2).flatten(1).mean(1)
+            psnrs += [math.inf if m == 0 else 10 * math.log10(1.0 / m) for m in mse.tolist()]
+
+    return {
+        'tiles': tiles.size(0),
+        'psnr_mean': sum(psnrs) / len(psnrs),
+        'psnr_min': min(psnrs),
+        'max_abs_diff': max_abs_diff,
+        'reference_seconds': reference_time,
+        'candidate_seconds': candidate_time,
+    }
+
+def format_report(stats: dict, label: str = 'int8') -> str:
+    speedup = stats['reference_seconds'] / max(stats['candidate_seconds'], 1e-9)
+    return '\n'.join([
+        f"{label} vs fp32 on {stats['tiles']} calibration tiles:",
+        f"  PSNR mean {stats['psnr_mean']:.2f} dB, min {stats['psnr_min']:.2f} dB",
+        f"  max abs diff {stats['max_abs_diff']:.4f} ({stats['max_abs_diff'] * 255:.1f} grey levels)",
+        f"  time fp32 {stats['reference_seconds']:.3f}s, {label} {stats['candidate_seconds']:.3f}s ({speedup:.2f}x)",
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize the AtoB generator to int8 for CPU inference and report the quality cost.')
+    parser.add_argument('--model_path', type=str, default='Output/S-color0.5/model/netG_A2B.pth', help='Path to the trained generator checkpoint (netG_A2B).')
+    parser.add_argument('--calib_dir', type=str, required=True, help='Folder of sample documents used for calibration and the comparison report.')
+    parser.add_argument('--calib_images', type=int, default=8, help='Maximum number of images taken from --calib_dir.')
+    parser.add_argument('--mode', type=str, default='static', choices=['dynamic', 'static'], help='Quantization mode.')
+    parser.add_argument('--patch_size', type=int, default=256, help='Size of the calibration patches.')
+    parser.add_argument('--input_nc', type=int, default=3, help='Number of channels of input data for the model.')
+    parser.add_argument('--output_nc', type=int, default=3, help='Number of channels of output data for the model.')
+    parser.add_argument('--output', type=str, default=None, help='Optional path to save the quantized model as a TorchScript artifact (load it with inference.py --backend torchscript).')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model_path):
+        print(f"Error: Model file not found at {args.model_path}")
+        return
+
+    model = load_model(args.model_path, 'eager', args.input_nc, args.output_nc, optimize=False)
+    calib_tiles = load_calibration_tiles(args.calib_dir, args.patch_size, args.calib_images)
+    print(f"Calibrating on {calib_tiles.size(0)} tiles from {args.calib_dir} ...")
+    quantized = quantize_model(model, args.mode, calib_tiles)
+    print(format_report(compare_models(model, quantized, calib_tiles), f"int8 ({args.mode})"))
+
+    if args.output:
+        with torch.no_grad():
+            scripted = torch.jit.trace(quantized, calib_tiles[:1])
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        torch.jit.save(torch.jit.freeze(scripted), args.output)
+        print(f"Saved quantized TorchScript artifact to: {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import io
+import json
+import math
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+
+from inference import (PatchBatcher, PatchBatchError, load_model, make_batch_runner, image_to_tensor,
+                       extract_tiles, stitch_tiles, tensor_to_pil)
+
+class _Job:
+    """Tiles of one request waiting for the model thread."""
+
+    def __init__(self, tiles: torch.Tensor):
+        self.tiles = tiles
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class DynamicBatcher:
+    """Merges tiles from concurrent requests into shared model batches.
+
+    A single model thread takes the first waiting request, then keeps collecting tiles
+    from further requests until ``max_batch_size`` tiles are pending or ``max_wait_ms``
+    has passed, and runs everything pending through the model.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int, max_wait_ms: float, metrics=None):
+        self.batcher = PatchBatcher(self._run_batch, max_batch_size)
+        self.run_batch = run_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics
+        self._jobs = queue.Queue()
+        self._in_flight = {}
+        self._next_id = 0
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, tiles: torch.Tensor) -> torch.Tensor:
+        """Blocks until every tile of a request has been processed and returns the outputs."""
+        job = _Job(tiles)
+        self._jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run_batch(self, tiles: torch.Tensor) -> torch.Tensor:
+        if self.metrics is not None:
+            self.metrics.record_batch(tiles.size(0))
+        return self.run_batch(tiles)
+
+    def _add(self, job: _Job):
+        job_id = self._next_id
+        self._next_id += 1
+        self._in_flight[job_id] = job
+        try:
+            self._complete(self.batcher.add(job_id, job.tiles))
+        except PatchBatchError as e:
+            self._fail(e)
+
+    def _complete(self, finished):
+        for job_id, outputs in finished:
+            job = self._in_flight.pop(job_id)
+            job.result = outputs
+            job.done.set()
+
+    def _fail(self, e: PatchBatchError):
+        traceback.print_exception(e.cause)
+        for job_id in e.keys:
+            job = self._in_flight.pop(job_id)
+            job.error = e.cause
+            job.done.set()
+
+    def _loop(self):
+        while True:
+            self._add(self._jobs.get())
+            deadline = time.monotonic() + self.max_wait
+            while self.batcher.pending_patches:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    self._add(self._jobs.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    self._complete(self.batcher.flush())
+                    break
+                except PatchBatchError as e:
+                    self._fail(e)
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+class ServerMetrics:
+    """Request latency percentiles and throughput counters for /metrics."""
+
+    def __init__(self, window: int = 10000):
+        self.start_time = time.time()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.tiles = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def record_request(self, seconds: float, error: bool = False):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(seconds)
+
+    def record_batch(self, tiles: int):
+        with self._lock:
+            self.batches += 1
+            self.tiles += tiles
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            uptime = time.time() - self.start_time
+            latencies = sorted(self.latencies)
+            completed = self.requests - self.errors
+            return {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'images_per_s': completed / uptime if uptime > 0 else 0.0,
+                'tiles_per_s': self.tiles / uptime if uptime > 0 else 0.0,
+                'batches': self.batches,
+                'mean_batch_size': self.tiles / self.batches if self.batches else 0.0,
+                'latency_ms': {
+                    'p50': percentile(latencies, 0.50) * 1000,
+                    'p95': percentile(latencies, 0.95) * 1000,
+                    'p99': percentile(latencies, 0.99) * 1000,
+                },
+            }
+
+def make_handler(batcher: DynamicBatcher, metrics: ServerMetrics, patch_size: int, overlap: int):
+    class CleaningHandler(BaseHTTPRequestHandler):
+        """POST /clean with raw image bytes returns the cleaned PNG; GET /metrics and /health report status."""
+
+        def _send(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, payload: dict):
+            self._send(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, metrics.snapshot())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/clean':
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            start = time.time()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                image = Image.open(io.BytesIO(self.rfile.read(length)))
+                tiles, layout = extract_tiles(image_to_tensor(image), patch_size, overlap)
+            except Exception as e:
+                metrics.record_request(time.time() - start, error=True)
+                self._send_json(400, {'error': f"Could not decode image: {e}"})
+                return
+            try:
+                cleaned = tensor_to_pil(stitch_tiles(batcher.submit(tiles), layout))
+                buffer = io.BytesIO()
+                cleaned.save(buffer, format='PNG')
+            except Exception as e:
+                metrics.record_request(time.time() - start, error=True)
+                self._send_json(500, {'error': f"Inference failed: {e}"})
+                return
+            metrics.record_request(time.time() - start)
+            self._send(200, buffer.getvalue(), 'image/png')
+
+        def log_message(self, format, *args):
+            pass
+
+    return CleaningHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HTTP server that keeps AtoB warm and cleans uploaded document images.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to bind (localhost by default).')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--model_path', type=str, default='Output/S-color0.5/model/netG_A2B.pth', help='Path to the generator checkpoint or exported artifact.')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnxruntime'], help='Model backend, as in inference.py.')
+    parser.add_argument('--patch_size', type=int, default=256, help='Size of the image patches.')
+    parser.add_argument('--overlap', type=int, default=32, help='Pixels shared by neighbouring patches.')
+    parser.add_argument('--max_batch_size', type=int, default=16, help='Maximum number of patches per model call, across requests.')
+    parser.add_argument('--max_wait_ms', type=float, default=10.0, help='How long a partial batch may wait for patches from other requests.')
+    parser.add_argument('--input_nc', type=int, default=3, help='Number of channels of input data for the model.')
+    parser.add_argument('--output_nc', type=int, default=3, help='Number of channels of output data for the model.')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default).')
+    parser.add_argument('--cuda', action='store_true', help='Use GPU computation if available.')
+    args = parser.parse_args()
+
+    if args.patch_size <= 0:
+        parser.error('--patch_size must be a positive integer.')
+    if args.max_batch_size <= 0:
+        parser.error('--max_batch_size must be a positive integer.')
+
+    if not 0 <= args.overlap <= args.patch_size // 2:
+        print("Error: --overlap must be between 0 and half of --patch_size.")
+        return
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if args.cuda and torch.cuda.is_available() and args.backend != 'onnxruntime' else 'cpu')
+    model = load_model(args.model_path, args.backend, args.input_nc, args.output_nc, device)
+    print(f"Model loaded from {args.model_path} ({args.backend} backend, {device.type}).")
+
+    metrics = ServerMetrics()
+    batcher = DynamicBatcher(make_batch_runner(model, args.backend, device), args.max_batch_size,
+                             args.max_wait_ms, metrics)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, metrics, args.patch_size, args.overlap))
+    print(f"Serving on http://{args.host}:{args.port} (POST /clean, GET /metrics, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ import torch
 
 from models import S, BtoA, AtoB
 from datasets import ImageDataset
+from profiler import ModuleProfiler
 
 #print("Time of operation...")
 if not os.path.exists('Output/S-color0.5/'):
@@ -33,6 +34,7 @@ parser.add_argument('--generator_A2B', type=str, default='Output/S-color0.5/mode
 parser.add_argument('--generator_B2A', type=str, default='Output/S-color0.5/model/netG_B2A.pth', help='B2A generator checkpoint file')
 parser.add_argument('--generator_E1', type=str, default='Output/S-color0.5/model/netG_E1.pth', help='E generator checkpoint file')
 parser.add_argument('--generator_E2', type=str, default='Output/S-color0.5/model/netG_E2.pth', help='E generator checkpoint file')
+parser.add_argument('--profile', action='store_true', help='time every submodule of the generators and write a Chrome trace')
 opt = parser.parse_args()
 print(opt) 
 
@@ -85,6 +87,8 @@ dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, mode
 
 ###### Testing######
 
+profiler = ModuleProfiler({'netG_A2B': netG_A2B, 'netG_B2A': netG_B2A}).attach() if opt.profile else None
+
 # Create output dirs if they don't exist
 if not os.path.exists('Output/S-color0.5/result/img_a11'):
     os.makedirs('Output/S-color0.5/result/img_a11')
@@ -108,6 +112,9 @@ for i, batch in enumerate(dataloader):
     sys.stdout.write('\rGenerated images %04d of %04d' % (i+1, len(dataloader)))
 
 sys.stdout.write('\n')
+if profiler is not None:
+    profiler.detach()
+    print(profiler.report('Output/S-color0.5/profile_trace.json'))
 ###################################
 end_time = time.time()
 print(f"Time of operation in {end_time-start_time:.4f} seconds")
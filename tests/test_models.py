@@ -0,0 +1,12 @@
+import pytest
+import torch
+
+from models import AtoB, BtoA, S, check_inference_equivalence
+
+
+@pytest.mark.parametrize('channels_last', [True, False])
+@pytest.mark.parametrize('generator', [AtoB, BtoA, S])
+def test_optimize_for_inference_matches_eager(generator, channels_last):
+    torch.manual_seed(0)
+    ok, max_abs_diff = check_inference_equivalence(generator(3, 3), channels_last=channels_last)
+    assert ok, f"{generator.__name__} (channels_last={channels_last}) differs from eager by {max_abs_diff:.2e}"
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
 import sys
 import itertools
 
@@ -9,7 +10,6 @@ from torch.utils.data import DataLoader
 from torch.autograd import Variable
 import torch
 from PIL import Image
-import torch.nn as nn
 
 # --- Diagnostic: Checking CUDA availability in train.py ---
 print("--- Diagnostic: Checking CUDA availability in train.py ---")
@@ -31,18 +31,20 @@ print("--- End Diagnostic ---")
 
 
 from models import S, BtoA, AtoB
-from models import Discriminator
+from models import Discriminator, use_fp32_norms, set_checkpointing
 from utils import ReplayBuffer
 from utils import LambdaLR
 from utils import Logger
 from utils import weights_init_normal
-from datasets import ImageDataset
-from utils import VGGNet
+from datasets import ImageDataset, CachedImageDataset, TarShardDataset, BatchAugment, pad_collate, ResumableSampler
+from utils import PerceptualLoss
+from profiler import ModuleProfiler
+from training import train_step, MixedPrecision, init_distributed, wrap_distributed, unwrap
+from checkpoint import CheckpointManager, to_cpu, rng_state, set_rng_state
 
 # python -m visdom.server
 import os
-
-os.environ["CUDA_VISIBLE_DEVICES"] = '1'
+import torch.distributed as dist
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--epoch', type=int, default=0, help='starting epoch')
@@ -65,6 +67,42 @@ parser.add_argument('--output_nc', type=int, default=3,
 parser.add_argument('--cuda', action='store_true', default='true', help='use GPU computation')
 parser.add_argument('--n_cpu', type=int, default=0,
                     help='number of cpu threads to use during batch generation')
+parser.add_argument('--cache', action='store_true',
+                    help='serve training crops from a pre-resized memory-mapped cache (built on first use)')
+parser.add_argument('--shards', type=str, default=None,
+                    help='stream training pairs from tar shards in this directory (see datasets.py --build shards)')
+parser.add_argument('--batch_aug', action='store_true',
+                    help='crop, flip and normalize whole uint8 batches on the training device instead of per sample in the loader')
+parser.add_argument('--buffer_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16', 'uint8'],
+                    help='storage type of the replay buffers of generated images')
+parser.add_argument('--log_backend', type=str, default='visdom', choices=['visdom', 'jsonl', 'csv', 'tensorboard', 'none'],
+                    help='where loss curves and sample images go; visdom falls back to jsonl without a server')
+parser.add_argument('--log_interval', type=int, default=50,
+                    help='batches between loss reports (each report syncs the device once)')
+parser.add_argument('--image_interval', type=int, default=500,
+                    help='batches between sample image uploads (0 disables them)')
+parser.add_argument('--vgg_layers', type=int, nargs='+', default=[9, 36],
+                    help='vgg19.features indices compared by the perceptual loss')
+parser.add_argument('--vgg_weights', type=float, nargs='+', default=None,
+                    help='weight of each --vgg_layers term (default: 1 each)')
+parser.add_argument('--amp', action='store_true',
+                    help='mixed precision: bfloat16 autocast on CPU, float16 autocast with gradient scaling on GPU')
+parser.add_argument('--checkpointing', type=str, nargs='*', default=[], choices=['tfam', 'branch', 'residual'],
+                    help='recompute activations of these generator blocks in backward to save memory: tfam (TFAM groups), branch (De_remove/De_predict/Re_pretict), residual (ResidualBlock)')
+parser.add_argument('--profile', action='store_true',
+                    help='time every submodule for the first --profile_steps iterations and write a Chrome trace')
+parser.add_argument('--profile_steps', type=int, default=10,
+                    help='number of iterations profiled with --profile')
+parser.add_argument('--dist_backend', type=str, default=None, choices=['gloo', 'nccl'],
+                    help='process group backend when launched with torchrun (default: nccl with --cuda, gloo on CPU)')
+parser.add_argument('--ckpt_dir', type=str, default='Output/S-color0.5/checkpoints',
+                    help='directory of the full training checkpoints')
+parser.add_argument('--ckpt_every', type=int, default=0,
+                    help='also write a full checkpoint every N iterations (0: only at the end of each epoch)')
+parser.add_argument('--keep_last', type=int, default=3,
+                    help='number of newest full checkpoints kept, besides the one with the lowest generator loss')
+parser.add_argument('--resume', type=str, default=None,
+                    help="continue from a full checkpoint: 'latest', 'best' or a path in --ckpt_dir")
 opt = parser.parse_args()
 if isinstance(opt.cuda, str): # Mengkonversi string 'true' dari default ke boolean
     opt.cuda = opt.cuda.lower() == 'true'
@@ -76,7 +114,23 @@ if opt.cuda and not torch.cuda.is_available():
 elif not opt.cuda and torch.cuda.is_available() and opt.epoch == 0: # Hanya print di awal
     print("INFO: CUDA is available, but --cuda flag was not set. Running on CPU. Add --cuda to use GPU.")
 
-device = torch.device('cuda' if opt.cuda else 'cpu')
+# Under torchrun every process trains a replica on its own slice of the data.
+rank, world_size, device = init_distributed(opt.cuda, opt.dist_backend)
+
+ckpt_manager = CheckpointManager(opt.ckpt_dir, keep_last=opt.keep_last, rank=rank)
+resume = ckpt_manager.load(opt.resume) if opt.resume else None
+# The LR schedule keeps the --epoch offset of the run that is being resumed.
+lr_offset = resume['lr_offset'] if resume else opt.epoch
+# The data order is drawn once per run, shared by all ranks and kept by --resume
+# (checkpoints without one predate it and used seed 0).
+if resume:
+    data_seed = resume.get('data_seed', 0)
+else:
+    data_seed = torch.initial_seed() % 2 ** 31
+    if world_size > 1:
+        seed = torch.tensor(data_seed, device=device)
+        dist.broadcast(seed, 0)
+        data_seed = int(seed.item())
 
 # Networks
 netG_A2B = AtoB(opt.input_nc, opt.output_nc).to(device)
@@ -86,6 +140,14 @@ netG_E2 = S(opt.input_nc, opt.input_nc).to(device)
 netD_A = Discriminator(opt.input_nc).to(device)
 netD_B = Discriminator(opt.output_nc).to(device)
 
+for net in (netG_A2B, netG_B2A, netG_E1, netG_E2):
+    set_checkpointing(net, opt.checkpointing)
+
+if opt.amp:
+    # InstanceNorm statistics stay in fp32 under autocast.
+    for net in (netG_A2B, netG_B2A, netG_E1, netG_E2, netD_A, netD_B):
+        use_fp32_norms(net)
+
 netG_A2B.apply(weights_init_normal)
 netG_B2A.apply(weights_init_normal)
 netG_E1.apply(weights_init_normal)
@@ -93,38 +155,9 @@ netG_E2.apply(weights_init_normal)
 netD_A.apply(weights_init_normal)
 netD_B.apply(weights_init_normal)
 
-# pretrained VGG19 module set in evaluation mode for feature extraction
-vgg = VGGNet().to(device).eval()
-
-
-def perceptual_loss(x, y):
-    c = nn.MSELoss()
-
-    rx = netG_B2A(netG_A2B(x))
-    ry = netG_A2B(netG_B2A(y))
-
-    fx1, fx2 = vgg(x)
-    fy1, fy2 = vgg(y)
+# frozen pretrained VGG19 features for the perceptual loss
+perceptual = PerceptualLoss(opt.vgg_layers, opt.vgg_weights).to(device)
 
-    frx1, frx2 = vgg(rx)
-    fry1, fry2 = vgg(ry)
-
-    m1 = c(fx1, frx1)
-    m2 = c(fx2, frx2)
-
-    m3 = c(fy1, fry1)
-    m4 = c(fy2, fry2)
-
-    loss = (m1 + m2 + m3 + m4)
-
-    return loss
-
-
-# Lossess
-criterion_GAN = torch.nn.MSELoss()  # Adversarial Loss
-criterion_cycle = torch.nn.L1Loss()  # Cyclic consistency loss
-criterion_identity = torch.nn.L1Loss()  # identity loss
-criterion_fGT = torch.nn.L1Loss()  # Pseudo-similarity loss
 
 # Optimizers & LR schedulers # bagian ini diubah karena duplikat
 optimizer_G = torch.optim.Adam(itertools.chain(netG_A2B.parameters(), netG_B2A.parameters(), netG_E1.parameters(), netG_E2.parameters()),
@@ -135,24 +168,73 @@ optimizer_D_B = torch.optim.Adam(
     netD_B.parameters(), lr=opt.lr, betas=(0.5, 0.999))
 
 lr_scheduler_G = torch.optim.lr_scheduler.LambdaLR(
-    optimizer_G, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
+    optimizer_G, lr_lambda=LambdaLR(opt.n_epochs, lr_offset, opt.decay_epoch).step)
 lr_scheduler_D_A = torch.optim.lr_scheduler.LambdaLR(
-    optimizer_D_A, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
+    optimizer_D_A, lr_lambda=LambdaLR(opt.n_epochs, lr_offset, opt.decay_epoch).step)
 lr_scheduler_D_B = torch.optim.lr_scheduler.LambdaLR(
-    optimizer_D_B, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
+    optimizer_D_B, lr_lambda=LambdaLR(opt.n_epochs, lr_offset, opt.decay_epoch).step)
 
 # Inputs & targets memory allocation
 input_A = torch.empty(opt.batchSize, opt.input_nc, opt.size, opt.size, device=device, dtype=torch.float32)
 input_B = torch.empty(opt.batchSize, opt.output_nc, opt.size, opt.size, device=device, dtype=torch.float32)
-target_real = Variable(torch.ones(opt.batchSize, 1, device=device, dtype=torch.float32),
-                       requires_grad=False)  # real
-target_fake = Variable(torch.zeros(opt.batchSize, 1, device=device, dtype=torch.float32),
-                       requires_grad=False)  # fake
 
-fake_A_buffer = ReplayBuffer()
-fake_B_buffer = ReplayBuffer()
-E_A_buffer = ReplayBuffer()
-E_B_buffer = ReplayBuffer()
+buffer_dtype = getattr(torch, opt.buffer_dtype)
+fake_A_buffer = ReplayBuffer(dtype=buffer_dtype)
+fake_B_buffer = ReplayBuffer(dtype=buffer_dtype)
+E_A_buffer = ReplayBuffer(dtype=buffer_dtype)
+E_B_buffer = ReplayBuffer(dtype=buffer_dtype)
+
+nets = {'G_A2B': netG_A2B, 'G_B2A': netG_B2A, 'G_E1': netG_E1, 'G_E2': netG_E2, 'D_A': netD_A, 'D_B': netD_B}
+optimizers = {'G': optimizer_G, 'D_A': optimizer_D_A, 'D_B': optimizer_D_B}
+buffers = {'fake_A': fake_A_buffer, 'fake_B': fake_B_buffer, 'E_A': E_A_buffer, 'E_B': E_B_buffer}
+schedulers = {'G': lr_scheduler_G, 'D_A': lr_scheduler_D_A, 'D_B': lr_scheduler_D_B}
+amp = MixedPrecision(device, enabled=opt.amp)
+
+start_epoch, start_batch, step = opt.epoch, 0, 0
+resume_rng = None
+if resume is not None:
+    for name, net in nets.items():
+        net.load_state_dict(resume['nets'][name])
+    for name, optimizer in optimizers.items():
+        optimizer.load_state_dict(resume['optimizers'][name])
+    for name, scheduler in schedulers.items():
+        scheduler.load_state_dict(resume['schedulers'][name])
+    if resume['scaler']:
+        amp.scaler.load_state_dict(resume['scaler'])
+    if resume['local'] is not None:
+        for name, buffer in buffers.items():
+            buffer.load_state_dict(resume['local']['buffers'][name])
+        resume_rng = resume['local']['rng']
+    start_epoch, start_batch, step = resume['epoch'], resume['batch'], resume['step']
+    print(f"Resuming at epoch {start_epoch}, batch {start_batch} (iteration {step})")
+    resume = None
+
+def checkpoint_state(epoch, batch):
+    """CPU snapshot of everything needed to continue at ``batch`` of ``epoch``; rank-local parts only on rank > 0."""
+    local = {'buffers': {name: buffer.state_dict() for name, buffer in buffers.items()}, 'rng': rng_state()}
+    if rank > 0:
+        return to_cpu({'local': local})
+    return to_cpu({'epoch': epoch, 'batch': batch, 'step': step, 'lr_offset': lr_offset, 'data_seed': data_seed,
+                   'nets': {name: unwrap(net).state_dict() for name, net in nets.items()},
+                   'optimizers': {name: optimizer.state_dict() for name, optimizer in optimizers.items()},
+                   'schedulers': {name: scheduler.state_dict() for name, scheduler in schedulers.items()},
+                   'scaler': amp.scaler.state_dict(), 'local': local})
+
+def checkpoint_metric():
+    """Mean generator loss since the previous checkpoint, averaged over the ranks."""
+    global metric_sum, metric_count
+    if metric_count == 0:
+        return None
+    metric = metric_sum / metric_count
+    if world_size > 1:
+        dist.all_reduce(metric)
+        metric = metric / world_size
+    metric_sum, metric_count = torch.zeros((), device=device), 0
+    return metric.item()
+
+if world_size > 1:
+    # Replay buffers, LR schedules and the GradScaler stay per rank; gradients are averaged.
+    nets = wrap_distributed(nets, device)
 
 # Dataset loader with data augmentations
 transforms_ = [transforms.Resize(int(opt.size * 1.12), Image.BICUBIC),
@@ -160,143 +242,121 @@ transforms_ = [transforms.Resize(int(opt.size * 1.12), Image.BICUBIC),
                transforms.RandomHorizontalFlip(),
                transforms.ToTensor(),
                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
-dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True),
-                        batch_size=opt.batchSize, shuffle=True, num_workers=opt.n_cpu)
-
-# Loss plot
-logger = Logger(opt.n_epochs, len(dataloader))
+if opt.batch_aug and opt.cache:
+    print("INFO: --cache already serves crops without PIL; ignoring --batch_aug.")
+    opt.batch_aug = False
+augment = None
+collate_fn = None
+if opt.batch_aug:
+    # Loader workers only decode and resize; cropping, flipping and normalization run per batch.
+    transforms_ = [transforms.Resize(int(opt.size * 1.12), Image.BICUBIC),
+                   transforms.PILToTensor()]
+    augment = BatchAugment(opt.size)
+    collate_fn = pad_collate
+if opt.shards:
+    dataset = TarShardDataset(opt.shards, transforms_=transforms_, unaligned=True, rank=rank, world_size=world_size,
+                              num_workers=opt.n_cpu, seed=data_seed)
+elif opt.cache:
+    # Rank 0 builds a missing or stale cache before the other ranks open it.
+    if rank > 0:
+        dist.barrier()
+    dataset = CachedImageDataset(opt.dataroot, opt.size, load_size=int(opt.size * 1.12), unaligned=True)
+    if rank == 0 and world_size > 1:
+        dist.barrier()
+else:
+    dataset = ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True)
+sampler = None
+if not opt.shards:
+    # Split across ranks, and in an order that depends only on the epoch so --resume can skip ahead.
+    sampler = ResumableSampler(dataset, num_replicas=world_size, rank=rank, seed=data_seed)
+# Shard datasets shuffle themselves; DataLoader only accepts samplers for map-style datasets.
+dataloader = DataLoader(dataset, batch_size=opt.batchSize, sampler=sampler, num_workers=opt.n_cpu,
+                        collate_fn=collate_fn)
+
+# Loss plot (rank 0 only)
+logger = None
+if rank == 0:
+    logger = Logger(opt.n_epochs, len(dataloader), backend=opt.log_backend, log_interval=opt.log_interval,
+                    image_interval=opt.image_interval, log_dir='Output/S-color0.5/logs')
+    if opt.resume:
+        logger.resume(start_epoch + 1, start_batch + 1)
 ###################################
 
-if not os.path.exists('Output/S-color0.5/model'):
+if rank == 0 and not os.path.exists('Output/S-color0.5/model'):
     os.makedirs('Output/S-color0.5/model')
+profiler = None
+if opt.profile and rank == 0:
+    profiler = ModuleProfiler({'netG_A2B': netG_A2B, 'netG_B2A': netG_B2A, 'netG_E1': netG_E1,
+                               'netG_E2': netG_E2, 'netD_A': netD_A, 'netD_B': netD_B}).attach()
+profile_until = step + opt.profile_steps
+batches_epoch = len(dataloader)
+metric_sum, metric_count = torch.zeros((), device=device), 0
 ###### Training ######
-for epoch in range(opt.epoch, opt.n_epochs):
-    for i, batch in enumerate(dataloader):
+for epoch in range(start_epoch, opt.n_epochs):
+    skip = start_batch if epoch == start_epoch else 0
+    if opt.shards:
+        dataset.set_epoch(epoch)
+    if sampler is not None:
+        sampler.set_epoch(epoch, skip=skip * opt.batchSize)
+    # The random state is restored where it was saved: between epochs, or after the
+    # loader of the interrupted epoch has been set up.
+    if resume_rng is not None and skip == 0:
+        set_rng_state(resume_rng)
+        resume_rng = None
+    batches = iter(dataloader)
+    if opt.shards and skip:
+        # A stream can only be fast-forwarded by reading past the finished batches.
+        collections.deque(itertools.islice(batches, skip), maxlen=0)
+    if resume_rng is not None:
+        set_rng_state(resume_rng)
+        resume_rng = None
+    for i, batch in enumerate(batches, start=skip):
         # Set model input
         # Pindahkan batch data ke device yang benar
-        real_A = Variable(input_A.copy_(batch['A'])).to(device) 
-        real_B = Variable(input_B.copy_(batch['B'])).to(device)
-
-        ###### Generators A2B and B2A ######
-        optimizer_G.zero_grad()
-
-        # GAN loss
-        fake_B = netG_A2B(real_A)
-        pred_fake = netD_B(fake_B)
-        loss_GAN_A2B1 = criterion_GAN(pred_fake, target_real)
-        fake_BE = netG_E1(fake_B)
-        pred_fake2 = netD_B(fake_BE)
-        loss_GAN_A2B2 = criterion_GAN(pred_fake2, target_real)
-        loss_GAN_A2B = loss_GAN_A2B1 + loss_GAN_A2B2
-
-        fake_A = netG_B2A(real_B)
-        pred_fake = netD_A(fake_A)
-        loss_GAN_B2A1 = criterion_GAN(pred_fake, target_real)
-        fake_AE = netG_E2(fake_A)
-        pred_fake2 = netD_A(fake_AE)  # Diganti dari netD_B ke netD_A # kembali lagi ke awal
-        loss_GAN_B2A2 = criterion_GAN(pred_fake2, target_real)
-        loss_GAN_B2A = loss_GAN_B2A1 + loss_GAN_B2A2
-
-        # Identity loss
-        loss_id_B2A = criterion_identity(netG_B2A(real_A), real_A) * 5.0
-        loss_id_A2B = criterion_identity(netG_A2B(real_B), real_B) * 5.0
-
-        # loss_identity = (loss_id_A + loss_id_B) / 2
-
-        # Cycle loss
-        recovered_A = netG_B2A(fake_B)
-
-        recovered_B = netG_A2B(fake_A)
-
-        loss_cycle_ABA = criterion_cycle(recovered_A, real_A) * 10.0
-        loss_cycle_BAB = criterion_cycle(recovered_B, real_B) * 10.0
-        loss_cycle_1 = (loss_cycle_ABA + loss_cycle_BAB)
-        # Cycle loss1
-        #E_A = netG_E1(fake_B)
-        #E_B = netG_E2(fake_A)
-        recovered_A2 = netG_B2A(fake_BE)
-        recovered_B2 = netG_A2B(fake_AE)
-
-        loss_cycle_ABEA = criterion_cycle(recovered_A2, real_A) * 10.0
-        loss_cycle_BAEB = criterion_cycle(recovered_B2, real_B) * 10.0
-        loss_cycle_2 = (loss_cycle_ABEA + loss_cycle_BAEB)
-        # Perceptual loss
-        loss_perceptual = perceptual_loss(real_A, real_B)
-        # ps loss
-        loss_fGT = (criterion_fGT(fake_B, fake_BE) + criterion_fGT(fake_A, fake_AE)) * 0.5
-
-        # Total loss
-        loss_G = loss_perceptual * 0.7 + loss_GAN_A2B + loss_GAN_B2A + loss_cycle_1 + loss_cycle_2 + loss_id_B2A + loss_id_A2B + loss_fGT
-        loss_G.backward()
-
-
-        optimizer_G.step()
-        ###################################
-
-        ###### Discriminator A ######
-        optimizer_D_A.zero_grad()
-
-        # Real loss
-        pred_real = netD_A(real_A)
-        loss_D_real = criterion_GAN(pred_real, target_real)
-
-        # Fake loss
-        fake_A = fake_A_buffer.push_and_pop(fake_A)
-        pred_fake = netD_A(fake_A.detach())
-        loss_D_fake1 = criterion_GAN(pred_fake, target_fake)
-        E_B = E_B_buffer.push_and_pop(fake_AE)
-        pred_fake1 = netD_A(E_B.detach())
-        loss_D_fake2 = criterion_GAN(pred_fake1, target_fake)
-        loss_D_fake = loss_D_fake1 + loss_D_fake2
-        # Total loss
-        loss_D_A = (loss_D_real + loss_D_fake) * 0.5
-        loss_D_A.backward()
-
-        optimizer_D_A.step()
-        ###################################
-
-        ###### Discriminator B ######
-        optimizer_D_B.zero_grad()
-
-        # Real loss
-        pred_real = netD_B(real_B)
-        loss_D_real = criterion_GAN(pred_real, target_real)
-
-        # Fake loss
-        fake_B = fake_B_buffer.push_and_pop(fake_B)
-        pred_fake = netD_B(fake_B.detach())
-        loss_D_fake1 = criterion_GAN(pred_fake, target_fake)
-        E_A = E_A_buffer.push_and_pop(fake_BE)
-        pred_fake1 = netD_B(E_A.detach())
-        loss_D_fake2 = criterion_GAN(pred_fake1, target_fake)
-        loss_D_fake = loss_D_fake1 + loss_D_fake2
-        # Total loss
-        loss_D_B = (loss_D_real + loss_D_fake) * 0.5
-        loss_D_B.backward()
-
-        optimizer_D_B.step()
-        ###################################
-
-        # Progress report (http://localhost:8097)
-        # logged using visdom
-        logger.log({'L_G': loss_G, 'L_G_perceptual': loss_perceptual, 'L_G_GAN': (loss_GAN_A2B + loss_GAN_B2A),
-                    'L_G_cycle1': (loss_cycle_1), 'L_G_cycle2': (loss_cycle_2), 'L_fGT': (loss_fGT),
-                    'L_G_identity': (loss_id_B2A + loss_id_A2B), 'L_D': (loss_D_A + loss_D_B)},
-                   images={'real_A': real_A,  'fake_B': fake_B, 'recovered_A': recovered_A, 'fake_BE': fake_BE,  'recovered_A2': recovered_A2,
-                           'real_B': real_B,  'fake_A': fake_A, 'recovered_B': recovered_B, 'fake_AE': fake_AE,  'recovered_B2': recovered_B2})
+        if augment is not None:
+            real_A = input_A.copy_(augment(batch['A'].to(device, non_blocking=True), batch['A_size']))
+            real_B = input_B.copy_(augment(batch['B'].to(device, non_blocking=True), batch['B_size']))
+        else:
+            real_A = Variable(input_A.copy_(batch['A'])).to(device) 
+            real_B = Variable(input_B.copy_(batch['B'])).to(device)
+
+        losses, images = train_step(nets, optimizers, buffers, perceptual, real_A, real_B, amp)
+
+        # Progress report (http://localhost:8097 with the visdom backend)
+        if logger is not None:
+            logger.log(losses, images=images)
+
+        step += 1
+        metric_sum = metric_sum + losses['L_G'].detach()
+        metric_count += 1
+        if opt.ckpt_every and step % opt.ckpt_every == 0 and i + 1 < batches_epoch:
+            ckpt_manager.save(checkpoint_state(epoch, i + 1), epoch, step, checkpoint_metric())
+
+        if profiler is not None and step == profile_until:
+            profiler.detach()
+            print(profiler.report('Output/S-color0.5/profile_trace.json'))
+            profiler = None
 
     # Update learning rates
     lr_scheduler_G.step()
     lr_scheduler_D_A.step()
     lr_scheduler_D_B.step()
 
-    # Save models checkpoints
-    torch.save(netG_A2B.state_dict(), 'Output/S-color0.5/model/netG_A2B.pth')
-    torch.save(netG_B2A.state_dict(), 'Output/S-color0.5/model/netG_B2A.pth')
-    torch.save(netG_E1.state_dict(), 'Output/S-color0.5/model/netG_E1.pth')
-    torch.save(netG_E2.state_dict(), 'Output/S-color0.5/model/netG_E2.pth')
-    torch.save(netD_A.state_dict(), 'Output/S-color0.5/model/netD_A.pth')
-    torch.save(netD_B.state_dict(), 'Output/S-color0.5/model/netD_B.pth')
+    # Save models checkpoints (the unwrapped modules, so the keys match single-process runs)
+    if rank == 0:
+        ckpt_manager.save_files({'Output/S-color0.5/model/netG_A2B.pth': to_cpu(netG_A2B.state_dict()),
+                                 'Output/S-color0.5/model/netG_B2A.pth': to_cpu(netG_B2A.state_dict()),
+                                 'Output/S-color0.5/model/netG_E1.pth': to_cpu(netG_E1.state_dict()),
+                                 'Output/S-color0.5/model/netG_E2.pth': to_cpu(netG_E2.state_dict()),
+                                 'Output/S-color0.5/model/netD_A.pth': to_cpu(netD_A.state_dict()),
+                                 'Output/S-color0.5/model/netD_B.pth': to_cpu(netD_B.state_dict())})
+    ckpt_manager.save(checkpoint_state(epoch + 1, 0), epoch + 1, step, checkpoint_metric())
+
+ckpt_manager.close()
+if logger is not None:
+    logger.close()
+if world_size > 1:
+    dist.destroy_process_group()
 ###################################
 
 
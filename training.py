@@ -0,0 +1,194 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+class FP32Loss(nn.Module):
+    """Evaluates ``loss`` on fp32 copies of its inputs, so reductions stay in fp32 under --amp."""
+
+    def __init__(self, loss):
+        super(FP32Loss, self).__init__()
+        self.loss = loss
+
+    def forward(self, input, target):
+        return self.loss(input.float(), target.float())
+
+criterion_GAN = FP32Loss(nn.MSELoss())  # Adversarial Loss
+criterion_cycle = FP32Loss(nn.L1Loss())  # Cyclic consistency loss
+criterion_identity = FP32Loss(nn.L1Loss())  # identity loss
+criterion_fGT = FP32Loss(nn.L1Loss())  # Pseudo-similarity loss
+
+class MixedPrecision:
+    """autocast settings and gradient scaling for train_step.
+
+    bfloat16 on CPU, which needs no loss scaling, and float16 with a GradScaler on
+    CUDA. Disabled, every method falls through to plain fp32 training.
+    """
+
+    def __init__(self, device: torch.device, enabled: bool = True):
+        self.enabled = enabled
+        self.device_type = device.type
+        self.dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+        use_scaler = enabled and device.type == 'cuda'
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward_step(self, loss, optimizer):
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+
+    def update(self):
+        # Once per iteration, after all three optimizer steps.
+        self.scaler.update()
+
+def init_distributed(cuda: bool, backend: str = None):
+    """Joins the process group described by torchrun's RANK, WORLD_SIZE and LOCAL_RANK.
+
+    Returns ``(rank, world_size, device)``. With no WORLD_SIZE above 1 in the environment
+    nothing is initialized and training stays single-process. The backend defaults to
+    nccl with CUDA and gloo otherwise, so several CPU processes on one machine work too.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, torch.device('cuda' if cuda else 'cpu')
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend or ('nccl' if cuda else 'gloo'), rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+def wrap_distributed(nets: dict, device: torch.device) -> dict:
+    """DistributedDataParallel wrappers for ``nets``; rank 0's initial weights are broadcast to all ranks."""
+    device_ids = [device.index] if device.type == 'cuda' else None
+    # The networks keep no running statistics (InstanceNorm only), so there are no buffers to sync.
+    return {name: DistributedDataParallel(net, device_ids=device_ids, broadcast_buffers=False)
+            for name, net in nets.items()}
+
+def unwrap(net):
+    """The module inside a DistributedDataParallel wrapper, or ``net`` itself."""
+    return net.module if isinstance(net, DistributedDataParallel) else net
+
+def discriminate(netD, *batches):
+    """Runs ``netD`` once on the concatenated batches and splits the predictions back.
+
+    The discriminator treats every sample independently (InstanceNorm, per-image
+    pooling), so this gives the same predictions as one call per batch.
+    """
+    return netD(torch.cat(batches)).split([batch.shape[0] for batch in batches])
+
+def generator_forward(nets: dict, perceptual, real_A, real_B, reuse_cycle: bool = True):
+    """All generator-phase losses of one step, with every generator output computed once.
+
+    ``nets`` maps 'G_A2B', 'G_B2A', 'G_E1', 'G_E2', 'D_A' and 'D_B' to the networks and
+    ``perceptual(reals, recons)`` is a utils.PerceptualLoss. The perceptual loss compares
+    the real images with ``recovered_A``/``recovered_B`` from the cycle loss.
+    ``reuse_cycle=False`` reproduces the old loop instead, which ran both cycles again
+    for the perceptual loss. Both are the same loss in
+    expectation; they differ only in the dropout masks of the extra passes.
+
+    Returns the total generator loss, the named losses for the logger and the
+    generated images needed by the discriminator phase.
+    """
+    G_A2B, G_B2A, G_E1, G_E2 = nets['G_A2B'], nets['G_B2A'], nets['G_E1'], nets['G_E2']
+    # The discriminator gradients of this phase are zeroed before the D updates, so under
+    # DDP the discriminators run unwrapped here and those gradients are never all-reduced.
+    D_A, D_B = unwrap(nets['D_A']), unwrap(nets['D_B'])
+
+    # GAN loss
+    fake_B = G_A2B(real_A)
+    fake_BE = G_E1(fake_B)
+    pred_fake, pred_fake2 = discriminate(D_B, fake_B, fake_BE)
+    loss_GAN_A2B = (criterion_GAN(pred_fake, torch.ones_like(pred_fake))
+                    + criterion_GAN(pred_fake2, torch.ones_like(pred_fake2)))
+
+    fake_A = G_B2A(real_B)
+    fake_AE = G_E2(fake_A)
+    pred_fake, pred_fake2 = discriminate(D_A, fake_A, fake_AE)
+    loss_GAN_B2A = (criterion_GAN(pred_fake, torch.ones_like(pred_fake))
+                    + criterion_GAN(pred_fake2, torch.ones_like(pred_fake2)))
+
+    # Identity loss
+    loss_id_B2A = criterion_identity(G_B2A(real_A), real_A) * 5.0
+    loss_id_A2B = criterion_identity(G_A2B(real_B), real_B) * 5.0
+
+    # Cycle loss
+    recovered_A = G_B2A(fake_B)
+    recovered_B = G_A2B(fake_A)
+    loss_cycle_1 = criterion_cycle(recovered_A, real_A) * 10.0 + criterion_cycle(recovered_B, real_B) * 10.0
+    recovered_A2 = G_B2A(fake_BE)
+    recovered_B2 = G_A2B(fake_AE)
+    loss_cycle_2 = criterion_cycle(recovered_A2, real_A) * 10.0 + criterion_cycle(recovered_B2, real_B) * 10.0
+
+    # Perceptual loss
+    if reuse_cycle:
+        loss_perceptual = perceptual([real_A, real_B], [recovered_A, recovered_B])
+    else:
+        loss_perceptual = perceptual([real_A, real_B], [G_B2A(G_A2B(real_A)), G_A2B(G_B2A(real_B))])
+    # ps loss
+    loss_fGT = (criterion_fGT(fake_B, fake_BE) + criterion_fGT(fake_A, fake_AE)) * 0.5
+
+    loss_G = (loss_perceptual * 0.7 + loss_GAN_A2B + loss_GAN_B2A + loss_cycle_1 + loss_cycle_2
+              + loss_id_B2A + loss_id_A2B + loss_fGT)
+    losses = {'L_G': loss_G, 'L_G_perceptual': loss_perceptual, 'L_G_GAN': (loss_GAN_A2B + loss_GAN_B2A),
+              'L_G_cycle1': loss_cycle_1, 'L_G_cycle2': loss_cycle_2, 'L_fGT': loss_fGT,
+              'L_G_identity': (loss_id_B2A + loss_id_A2B)}
+    images = {'fake_B': fake_B, 'recovered_A': recovered_A, 'fake_BE': fake_BE, 'recovered_A2': recovered_A2,
+              'fake_A': fake_A, 'recovered_B': recovered_B, 'fake_AE': fake_AE, 'recovered_B2': recovered_B2}
+    return loss_G, losses, images
+
+def discriminator_loss(netD, real, fake, fake_E):
+    """LSGAN loss of one discriminator on a real batch and two (already buffered) fake batches."""
+    pred_real, pred_fake, pred_fake1 = discriminate(netD, real, fake.detach(), fake_E.detach())
+    loss_D_real = criterion_GAN(pred_real, torch.ones_like(pred_real))
+    loss_D_fake = (criterion_GAN(pred_fake, torch.zeros_like(pred_fake))
+                   + criterion_GAN(pred_fake1, torch.zeros_like(pred_fake1)))
+    return (loss_D_real + loss_D_fake) * 0.5
+
+def train_step(nets: dict, optimizers: dict, buffers: dict, perceptual, real_A, real_B, amp: MixedPrecision = None):
+    """One full training iteration: generator update, then discriminator A and B updates.
+
+    ``optimizers`` holds 'G', 'D_A' and 'D_B'; ``buffers`` holds the 'fake_A', 'fake_B',
+    'E_A' and 'E_B' replay buffers. ``nets`` may be wrap_distributed wrappers; the buffers
+    stay local to each rank. Forward passes run under ``amp`` (plain fp32 when None).
+    Returns the named losses and images for the logger.
+    """
+    amp = amp or MixedPrecision(real_A.device, enabled=False)
+
+    ###### Generators A2B and B2A ######
+    optimizers['G'].zero_grad()
+    with amp.autocast():
+        loss_G, losses, images = generator_forward(nets, perceptual, real_A, real_B)
+    amp.backward_step(loss_G, optimizers['G'])
+
+    ###### Discriminator A ######
+    optimizers['D_A'].zero_grad()
+    fake_A = buffers['fake_A'].push_and_pop(images['fake_A'])
+    E_B = buffers['E_B'].push_and_pop(images['fake_AE'])
+    with amp.autocast():
+        loss_D_A = discriminator_loss(nets['D_A'], real_A, fake_A, E_B)
+    amp.backward_step(loss_D_A, optimizers['D_A'])
+
+    ###### Discriminator B ######
+    optimizers['D_B'].zero_grad()
+    fake_B = buffers['fake_B'].push_and_pop(images['fake_B'])
+    E_A = buffers['E_A'].push_and_pop(images['fake_BE'])
+    with amp.autocast():
+        loss_D_B = discriminator_loss(nets['D_B'], real_B, fake_B, E_A)
+    amp.backward_step(loss_D_B, optimizers['D_B'])
+    amp.update()
+
+    losses['L_D'] = loss_D_A + loss_D_B
+    # As before, the logged fake_A/fake_B are the ones the discriminators saw.
+    images.update({'real_A': real_A, 'real_B': real_B, 'fake_A': fake_A, 'fake_B': fake_B})
+    return losses, images
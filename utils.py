@@ -1,11 +1,13 @@
-import random
+import csv
+import json
+import os
+import queue
+import threading
 import time
 import datetime
 import sys
 
-from torch.autograd import Variable
 import torch
-from visdom import Visdom
 import numpy as np
 import torch.nn as nn
 from torchvision import models
@@ -20,113 +22,312 @@ def tensor2image(tensor):
         image = np.tile(image, (3, 1, 1))
     return image.astype(np.uint8)
 
-# Logging function for visdom
+# Logging backends: each gets scalars, end-of-epoch scalars and uint8 CHW images
+
+
+class NullBackend():
+    def scalars(self, step, values):
+        pass
+
+    def epoch_scalars(self, epoch, values):
+        pass
+
+    def images(self, step, images):
+        pass
+
+    def close(self):
+        pass
+
+
+class VisdomBackend(NullBackend):
+    def __init__(self):
+        from visdom import Visdom
+        self.viz = Visdom(raise_exceptions=True)
+        if not self.viz.check_connection():
+            raise ConnectionError('no Visdom server reachable (start one with python -m visdom.server)')
+        self.loss_windows = {}
+        self.epoch_windows = {}
+        self.image_windows = {}
+
+    def scalars(self, step, values):
+        for name, value in values.items():
+            if name not in self.loss_windows:
+                self.loss_windows[name] = self.viz.line(X=np.array([step]), Y=np.array([value]),
+                                                        opts={'xlabel': 'batch', 'ylabel': name, 'title': name})
+            else:
+                self.viz.line(X=np.array([step]), Y=np.array([value]), win=self.loss_windows[name], update='append')
+
+    def epoch_scalars(self, epoch, values):
+        for name, value in values.items():
+            if name not in self.epoch_windows:
+                self.epoch_windows[name] = self.viz.line(X=np.array([epoch]), Y=np.array([value]),
+                                                         opts={'xlabel': 'epochs', 'ylabel': name, 'title': name})
+            else:
+                self.viz.line(X=np.array([epoch]), Y=np.array([value]), win=self.epoch_windows[name], update='append')
+
+    def images(self, step, images):
+        for name, image in images.items():
+            if name not in self.image_windows:
+                self.image_windows[name] = self.viz.image(image, opts={'title': name})
+            else:
+                self.viz.image(image, win=self.image_windows[name], opts={'title': name})
+
+
+class FileBackend(NullBackend):
+    """Appends scalars to ``scalars.jsonl`` or ``scalars.csv`` and saves images as PNGs in ``log_dir``."""
+
+    def __init__(self, log_dir, fmt='jsonl'):
+        os.makedirs(os.path.join(log_dir, 'images'), exist_ok=True)
+        self.log_dir = log_dir
+        self.fmt = fmt
+        self.file = open(os.path.join(log_dir, 'scalars.' + fmt), 'a', newline='')
+        self.writer = None
+
+    def _write(self, row):
+        if self.fmt == 'jsonl':
+            self.file.write(json.dumps(row) + '\n')
+        else:
+            if self.writer is None:
+                # Columns are fixed by the first row; a CSV header is only written to an empty file.
+                self.writer = csv.DictWriter(self.file, fieldnames=list(row), extrasaction='ignore')
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerow(row)
+        self.file.flush()
+
+    def scalars(self, step, values):
+        self._write(dict({'kind': 'batch', 'step': step, 'time': time.time()}, **values))
+
+    def epoch_scalars(self, epoch, values):
+        self._write(dict({'kind': 'epoch', 'step': epoch, 'time': time.time()}, **values))
+
+    def images(self, step, images):
+        from PIL import Image
+        for name, image in images.items():
+            Image.fromarray(image.transpose(1, 2, 0)).save(os.path.join(self.log_dir, 'images', '%08d_%s.png' % (step, name)))
+
+    def close(self):
+        self.file.close()
+
+
+class TensorBoardBackend(NullBackend):
+    def __init__(self, log_dir):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+
+    def scalars(self, step, values):
+        for name, value in values.items():
+            self.writer.add_scalar(name, value, step)
+
+    def epoch_scalars(self, epoch, values):
+        for name, value in values.items():
+            self.writer.add_scalar('epoch/' + name, value, epoch)
+
+    def images(self, step, images):
+        for name, image in images.items():
+            self.writer.add_image(name, image, step)
+
+    def close(self):
+        self.writer.close()
+
+
+def make_log_backend(name, log_dir):
+    """Creates a logging backend; an unreachable Visdom server falls back to the JSONL file backend."""
+    if name == 'visdom':
+        try:
+            return VisdomBackend()
+        except Exception as e:
+            print(f"WARNING: Visdom unavailable ({e}); logging to {log_dir}/scalars.jsonl instead.")
+            return FileBackend(log_dir, 'jsonl')
+    if name in ('jsonl', 'csv'):
+        return FileBackend(log_dir, name)
+    if name == 'tensorboard':
+        return TensorBoardBackend(log_dir)
+    if name == 'none':
+        return NullBackend()
+    raise ValueError(f"Unknown log backend: {name}")
 
 
 class Logger():
-    def __init__(self, n_epochs, batches_epoch):
-        self.viz = Visdom()
+    """Console progress plus loss curves and sample images through a pluggable backend.
+
+    Losses are summed on their device and only copied to the host (one sync) every
+    ``log_interval`` batches and at the end of an epoch. Images are taken every
+    ``image_interval`` batches. Backend calls run on a background thread fed by a
+    bounded queue; when the backend falls behind, new entries are dropped rather than
+    stalling training. Call close() at the end to flush it.
+    """
+
+    def __init__(self, n_epochs, batches_epoch, backend='visdom', log_interval=50, image_interval=500,
+                 log_dir='Output/S-color0.5/logs', queue_size=16):
+        self.backend = make_log_backend(backend, log_dir) if isinstance(backend, str) else backend
         self.n_epochs = n_epochs
         self.batches_epoch = batches_epoch
+        self.log_interval = max(log_interval, 1)
+        self.image_interval = image_interval
         self.epoch = 1
         self.batch = 1
-        self.prev_time = time.time()
-        self.mean_period = 0
+        self.first_batch = 1
+        self.step = 0
+        self.start_time = time.time()
         self.losses = {}
-        self.loss_windows = {}
-        self.image_windows = {}
+        self.epoch_losses = {}
+        self.interval_batches = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
 
-    def log(self, losses=None, images=None):
-        self.mean_period += (time.time() - self.prev_time)
-        self.prev_time = time.time()
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            kind, step, payload = item
+            try:
+                if kind == 'images':
+                    payload = {name: tensor2image(tensor) for name, tensor in payload.items()}
+                    self.backend.images(step, payload)
+                elif kind == 'epoch':
+                    self.backend.epoch_scalars(step, payload)
+                else:
+                    self.backend.scalars(step, payload)
+            except Exception as e:
+                print(f"\nWARNING: logging backend failed: {e}")
 
-        sys.stdout.write('\rEpoch %03d/%03d [%04d/%04d] -- ' %
-                         (self.epoch, self.n_epochs, self.batch, self.batches_epoch))
+    def _submit(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
 
-        for i, loss_name in enumerate(losses.keys()):
-            if loss_name not in self.losses:
-                self.losses[loss_name] = losses[loss_name].data
-            else:
-                self.losses[loss_name] += losses[loss_name].data
+    def _means(self, sums, count):
+        # One device-to-host copy for all losses.
+        names = list(sums)
+        values = torch.stack([sums[name].float() for name in names]).cpu().tolist()
+        return {name: value / count for name, value in zip(names, values)}
 
-            if (i+1) == len(losses.keys()):
-                sys.stdout.write('%s: %.4f -- ' %
-                                 (loss_name, self.losses[loss_name]/self.batch))
-            else:
-                sys.stdout.write('%s: %.4f | ' %
-                                 (loss_name, self.losses[loss_name]/self.batch))
-
-        batches_done = self.batches_epoch*(self.epoch - 1) + self.batch
-        batches_left = self.batches_epoch * \
-            (self.n_epochs - self.epoch) + self.batches_epoch - self.batch
-        sys.stdout.write('ETA: %s' % (datetime.timedelta(
-            seconds=batches_left*self.mean_period/batches_done)))
-
-        # Draw images
-        for image_name, tensor in images.items():
-            if image_name not in self.image_windows:
-                self.image_windows[image_name] = self.viz.image(
-                    tensor2image(tensor.data), opts={'title': image_name})
-            else:
-                self.viz.image(tensor2image(
-                    tensor.data), win=self.image_windows[image_name], opts={'title': image_name})
-
-        # End of epoch
-        # Plot losses
-        for loss_name, loss in self.losses.items():
-            if loss_name not in self.loss_windows:
-                self.loss_windows[loss_name] = self.viz.line(X=np.array([self.batch]), Y=np.array([loss.cpu().detach().numpy()/self.batch]),
-                                                             opts={'xlabel': 'batch', 'ylabel': loss_name, 'title': loss_name})
-            else:
-                self.viz.line(X=np.array([self.batch]), Y=np.array([loss.cpu().detach(
-                ).numpy()/self.batch]), win=self.loss_windows[loss_name], update='append')
-            # Reset losses for next epoch
-
-        if (self.batch % self.batches_epoch) == 0:
-            # Plot losses
-            for loss_name, loss in self.losses.items():
-                if ("epoch"+loss_name) not in self.loss_windows:
-                    epoch_loss_window = "epoch"+self.loss_windows[loss_name]
-                    epoch_loss_window = self.viz.line(X=np.array([self.epoch]), Y=np.array([loss.cpu().detach().numpy()/self.batch]),
-                                                      opts={'xlabel': 'epochs', 'ylabel': loss_name, 'title': loss_name})
-                else:
-                    epoch_loss_window = "epoch"+self.loss_windows[loss_name]
-                    self.viz.line(X=np.array([self.epoch]), Y=np.array(
-                        [loss.cpu().detach().numpy()/self.batch]), win=epoch_loss_window, update='append')
-                # Reset losses for next epoch
-                self.losses[loss_name] = 0.0
+    def log(self, losses=None, images=None):
+        self.step += 1
+        self.interval_batches += 1
+        for loss_name, loss in (losses or {}).items():
+            loss = torch.as_tensor(loss).detach()
+            self.losses[loss_name] = self.losses[loss_name] + loss if loss_name in self.losses else loss
+            self.epoch_losses[loss_name] = self.epoch_losses[loss_name] + loss if loss_name in self.epoch_losses else loss
+
+        end_of_epoch = (self.batch % self.batches_epoch) == 0
+        if self.losses and (self.step % self.log_interval == 0 or end_of_epoch):
+            means = self._means(self.losses, self.interval_batches)
+            batches_left = self.batches_epoch * (self.n_epochs - self.epoch) + self.batches_epoch - self.batch
+            eta = datetime.timedelta(seconds=batches_left * (time.time() - self.start_time) / self.step)
+            sys.stdout.write('\rEpoch %03d/%03d [%04d/%04d] -- ' % (self.epoch, self.n_epochs, self.batch, self.batches_epoch)
+                             + ' | '.join('%s: %.4f' % item for item in means.items()) + ' -- ETA: %s' % eta)
+            sys.stdout.flush()
+            self._submit(('scalars', self.step, means))
+            self.losses = {}
+            self.interval_batches = 0
 
+        if images and self.image_interval > 0 and self.step % self.image_interval == 0:
+            # Only the first sample is shown; the copy to the host happens on the logging thread.
+            self._submit(('images', self.step, {name: tensor[:1].detach().clone() for name, tensor in images.items()}))
+
+        if end_of_epoch:
+            if self.epoch_losses:
+                self._submit(('epoch', self.epoch, self._means(self.epoch_losses, self.batch - self.first_batch + 1)))
+            self.epoch_losses = {}
             self.epoch += 1
             self.batch = 1
+            self.first_batch = 1
             sys.stdout.write('\n')
         else:
             self.batch += 1
 
+    def resume(self, epoch, batch):
+        """Continues the counters of an interrupted run at ``epoch`` and ``batch`` (both 1-based)."""
+        self.epoch = epoch
+        self.batch = batch
+        self.first_batch = batch
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.backend.close()
+        if self.dropped:
+            print(f"Logger dropped {self.dropped} updates because the backend could not keep up.")
+
 # sets a buffer to input images
 
 
 class ReplayBuffer():
-    def __init__(self, max_size=50):
+    """History of generated images the discriminators are also trained on.
+
+    The history lives in one tensor allocated on the first push, on the device of the
+    pushed batch, and optionally stored as float16/bfloat16 or as uint8 (images in
+    [-1, 1] quantized to 256 levels) to save memory. While the buffer is filling, pushed
+    images are stored and returned as they are. Once full, each image is swapped with
+    probability 0.5 for a random stored one, which is returned in its place. Decisions
+    for the whole batch are drawn at once and every image of a batch draws a different
+    slot, so swaps read the buffer as it was before the batch and none overwrite each other.
+    """
+
+    def __init__(self, max_size=50, dtype=torch.float32):
         assert (
             max_size > 0), 'Empty buffer or trying to create a black hole. Be careful.'
         self.max_size = max_size
-        self.data = []
+        self.dtype = dtype
+        self.data = None
+        self.size = 0
+
+    def _encode(self, images):
+        if self.dtype == torch.uint8:
+            return images.add(1.0).mul_(127.5).round_().clamp_(0, 255).to(torch.uint8)
+        return images.to(self.dtype)
+
+    def _decode(self, stored, dtype):
+        if self.dtype == torch.uint8:
+            return stored.to(dtype).div_(127.5).sub_(1.0)
+        return stored.to(dtype)
 
     def push_and_pop(self, data):
-        to_return = []
-        for element in data.data:
-            element = torch.unsqueeze(element, 0)
-            if len(self.data) < self.max_size:
-                self.data.append(element)
-                to_return.append(element)
-            else:
-                if random.uniform(0, 1) > 0.5:
-                    i = random.randint(0, self.max_size-1)
-                    to_return.append(self.data[i].clone())
-                    self.data[i] = element
-                else:
-                    to_return.append(element)
-        return Variable(torch.cat(to_return))
+        data = data.detach()
+        if self.data is None:
+            self.data = torch.empty((self.max_size,) + tuple(data.shape[1:]), dtype=self.dtype, device=data.device)
+        elif self.data.device != data.device:
+            # Restored from a CPU checkpoint.
+            self.data = self.data.to(data.device)
+
+        # Fill the free slots in order with the first images of the batch.
+        n_fill = min(self.max_size - self.size, data.shape[0])
+        if n_fill > 0:
+            self.data[self.size:self.size + n_fill] = self._encode(data[:n_fill])
+            self.size += n_fill
+
+        # Each remaining image is swapped with probability 0.5 for the image in its own,
+        # distinct slot; batches larger than the buffer go in buffer-sized chunks. The
+        # swaps are masks rather than index lists, so nothing syncs with the host.
+        out = data.clone()
+        for start in range(n_fill, data.shape[0], self.max_size):
+            chunk = data[start:start + self.max_size]
+            n = chunk.shape[0]
+            swap = (torch.rand(n, device=data.device) > 0.5).view((n,) + (1,) * (chunk.dim() - 1))
+            slots = torch.randperm(self.max_size, device=data.device)[:n]
+            stored = self.data[slots]
+            self.data[slots] = torch.where(swap, self._encode(chunk), stored)
+            out[start:start + n] = torch.where(swap, self._decode(stored, data.dtype), chunk)
+        return out
+
+    def state_dict(self):
+        return {'max_size': self.max_size, 'size': self.size, 'data': self.data}
+
+    def load_state_dict(self, state):
+        assert state['max_size'] == self.max_size, 'Replay buffer size differs from the checkpoint.'
+        data = state['data']
+        if data is not None and data.dtype != self.dtype:
+            # --buffer_dtype changed since the checkpoint: re-encode through float32.
+            images = data.float().div(127.5).sub(1.0) if data.dtype == torch.uint8 else data.float()
+            data = self._encode(images)
+        self.data = data
+        self.size = state['size']
 
 # set decay
 
@@ -157,7 +358,7 @@ def weights_init_normal(m):
 
 
 class VGGNet(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         """Select conv1_1 ~ conv5_1 activation maps."""
         super(VGGNet, self).__init__()
         self.select = ['9', '36'] # Perhatikan bahwa indeks layer mungkin perlu disesuaikan jika arsitektur VGG berubah antar versi.
@@ -168,7 +369,7 @@ class VGGNet(nn.Module):
                                      # Jika Anda ingin fitur dari pooling layers, Anda mungkin perlu menyesuaikan.
                                      # Untuk saat ini, kita akan pertahankan '9' dan '36' sesuai kode asli,
                                      # namun ini adalah poin penting untuk diverifikasi jika perceptual loss tidak bekerja seperti yang diharapkan.
-        self.vgg = models.vgg19(weights=VGG19_Weights.IMAGENET1K_V1).features
+        self.vgg = models.vgg19(weights=VGG19_Weights.IMAGENET1K_V1 if pretrained else None).features
 
     def forward(self, x):
         """Extract multiple convolutional feature maps."""
@@ -178,3 +379,56 @@ class VGGNet(nn.Module):
             if name in self.select:
                 features.append(x)
         return features[0], features[1]
+
+# VGG19 perceptual loss: frozen, truncated after the deepest selected layer, batched
+
+
+class PerceptualLoss(nn.Module):
+    """Weighted MSE between VGG19 features of real images and of their reconstructions.
+
+    ``layers`` are indices into ``vgg19.features`` (the defaults match VGGNet) and
+    ``weights`` scale each layer's term. The VGG weights are frozen and the stack stops
+    after the deepest selected layer. All real images go through VGG in one batched
+    forward under no_grad, and all reconstructions in a second one. Called as
+    ``loss(reals, recons)`` with lists of equally sized batches, it returns the sum
+    over pairs and layers of ``weight * mse(real_features, recon_features)``.
+    """
+
+    def __init__(self, layers=(9, 36), weights=None, pretrained=True):
+        super(PerceptualLoss, self).__init__()
+        self.layers = [int(layer) for layer in layers]
+        self.weights = [float(w) for w in weights] if weights is not None else [1.0] * len(self.layers)
+        assert len(self.weights) == len(self.layers), 'Give one weight per VGG layer.'
+        features = models.vgg19(weights=VGG19_Weights.IMAGENET1K_V1 if pretrained else None).features
+        self.vgg = features[:max(self.layers) + 1]
+        for i in self.layers:
+            # A selected output must not be overwritten by the in-place ReLU right after it.
+            if i + 1 < len(self.vgg) and isinstance(self.vgg[i + 1], nn.ReLU):
+                self.vgg[i + 1].inplace = False
+        self.vgg.requires_grad_(False)
+        self.vgg.eval()
+
+    def train(self, mode=True):
+        # The feature extractor always stays in eval mode.
+        super(PerceptualLoss, self).train(mode)
+        self.vgg.eval()
+        return self
+
+    def features(self, x):
+        selected = {}
+        for i, layer in enumerate(self.vgg):
+            x = layer(x)
+            if i in self.layers:
+                selected[i] = x
+        return [selected[i] for i in self.layers]
+
+    def forward(self, reals, recons):
+        sizes = [real.shape[0] for real in reals]
+        with torch.no_grad():
+            real_features = [f.split(sizes) for f in self.features(torch.cat(reals))]
+        recon_features = [f.split(sizes) for f in self.features(torch.cat(recons))]
+        loss = 0
+        for pair in range(len(reals)):
+            for layer, weight in enumerate(self.weights):
+                loss = loss + weight * nn.functional.mse_loss(real_features[layer][pair].float(), recon_features[layer][pair].float())
+        return loss